@@ -0,0 +1,143 @@
+# Decoding of the xlogfile's bitfield fields (conduct, achieve, tnntachieveX).
+#
+# Conducts and achievements are each stored as a single bit in one of these
+# fields; which bit is which comes from the Conduct and Achievement tables
+# (loaded from the fixtures). Rather than testing every Conduct and Achievement
+# against every xlog line, the tables are compiled once into per-byte lookup
+# tables, so decoding a field costs one lookup per byte of the value no matter
+# how many achievements exist.
+from collections import defaultdict
+
+# Masks with a fixed meaning in NetHack/TNNT, which aren't Conducts or
+# Achievements themselves but decide how a line is ingested. They are
+# (xlogfield, mask) pairs, tested with test_mask().
+XLOG_MASKS = {
+    # wizard mode (0x1) or explore mode (0x2); these games are discarded
+    'debug':      ('flags',   0x1 | 0x2),
+    # ascended
+    'won':        ('achieve', 1 << 8),
+    # Mines' End luckstone (bit 9) or Sokoban prize (bit 10)
+    'mines_soko': ('achieve', (1 << 9) | (1 << 10)),
+}
+
+# The bitfield xlog fields that Games keep a raw copy of, in this order. Every
+# xlogfield used by a Conduct or Achievement must be one of these.
+GAME_BITFIELDS = ['conduct', 'achieve', 'tnntachieve0', 'tnntachieve1', 'tnntachieve2',
+                  'tnntachieve3', 'tnntachieve4']
+
+# The fields are unsigned 64-bit values, but database BIGINTs are signed, so
+# Games store them in two's complement.
+def to_signed64(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+# Combine a Game's raw bitfields (as stored, in GAME_BITFIELDS order) into one
+# int, with field i in bits 64*i to 64*i+63. Sets of conducts and achievements
+# can then be unioned with | and tested with the masks in BitfieldTable.
+def pack(values):
+    packed = 0
+    for i, value in enumerate(values):
+        packed |= (value & 0xffffffffffffffff) << (64 * i)
+    return packed
+
+def test_mask(xlog_dict, name):
+    # Return True if any bit of the named XLOG_MASKS entry is set in xlog_dict.
+    field, mask = XLOG_MASKS[name]
+    return bool(xlog_dict.get(field, 0) & mask)
+
+class BitfieldTable:
+    # Lookup tables for one kind of thing encoded in xlog bitfields (conducts
+    # or achievements). For each xlogfield there is a list with one entry per
+    # byte of the field, and each entry maps all 256 values of that byte to
+    # the tuple of ids whose bits are set in it.
+    # packed_bits maps each id to its bit in a pack()ed int, and packed_mask
+    # has all of them.
+
+    def __init__(self, entries):
+        # entries is an iterable of (xlogfield, bit, id)
+        bits_by_field = defaultdict(dict)
+        self.packed_bits = {}
+        for field, bit, pk in entries:
+            bits_by_field[field][bit] = pk
+            self.packed_bits[pk] = 1 << (64 * GAME_BITFIELDS.index(field) + bit)
+        self.packed_mask = 0
+        for packed_bit in self.packed_bits.values():
+            self.packed_mask |= packed_bit
+
+        self.fields = {}
+        for field, bitmap in bits_by_field.items():
+            nbytes = max(bitmap) // 8 + 1
+            self.fields[field] = [
+                tuple(tuple(bitmap[8 * b + i] for i in range(8)
+                            if (byte >> i) & 1 and (8 * b + i) in bitmap)
+                      for byte in range(256))
+                for b in range(nbytes)
+            ]
+
+    def count(self, packed):
+        # Return how many ids have their bit set in a pack()ed int.
+        return (packed & self.packed_mask).bit_count()
+
+    def decode(self, xlog_dict):
+        # Return a list of the ids whose bits are set in xlog_dict. Fields
+        # missing from xlog_dict (e.g. a tnntachieveX that a given version
+        # doesn't write) are treated as 0.
+        ids = []
+        for field, bytetables in self.fields.items():
+            value = xlog_dict.get(field)
+            if not value:
+                continue
+            for table in bytetables:
+                ids.extend(table[value & 0xff])
+                value >>= 8
+                if not value:
+                    break
+        return ids
+
+class BitfieldDecoder:
+    # The conduct and achievement tables together.
+
+    def __init__(self, conducts, achievements):
+        # both are iterables of (xlogfield, bit, id)
+        self.conducts = BitfieldTable(conducts)
+        self.achievements = BitfieldTable(achievements)
+
+    @classmethod
+    def from_db(cls):
+        # imported here to avoid a circular import with models.py
+        from scoreboard.models import Conduct, Achievement
+        return cls(Conduct.objects.values_list('xlogfield', 'bit', 'id'),
+                   Achievement.objects.values_list('xlogfield', 'bit', 'id'))
+
+    def xlog_fields(self):
+        # Every xlog field this decoder or XLOG_MASKS looks at, plus the ones
+        # Games keep.
+        return set(self.conducts.fields) | set(self.achievements.fields) \
+            | set(field for field, _ in XLOG_MASKS.values()) | set(GAME_BITFIELDS)
+
+    def decode_batch(self, game_ids, xlog_dicts):
+        # Given parallel lists of Game ids and the xlog dicts they came from,
+        # return two lists of (game_id, conduct_id) and (game_id,
+        # achievement_id) pairs, i.e. the through-table rows for the batch.
+        game_conducts = []
+        game_achievements = []
+        for game_id, xlog_dict in zip(game_ids, xlog_dicts):
+            game_conducts.extend((game_id, c) for c in self.conducts.decode(xlog_dict))
+            game_achievements.extend((game_id, a) for a in self.achievements.decode(xlog_dict))
+        return game_conducts, game_achievements
+
+# Conducts and achievements don't change over the lifetime of the tournament,
+# so the decoder is built on first use and then kept for the life of the
+# process. Pass reload=True after changing the Conduct or Achievement tables.
+_decoder = None
+
+def get_decoder(reload=False):
+    global _decoder
+    if _decoder is None or reload:
+        _decoder = BitfieldDecoder.from_db()
+    return _decoder
+
+# Use a decoder built elsewhere, e.g. in the process that started this one,
+# instead of building one from the database on first use.
+def set_decoder(decoder):
+    global _decoder
+    _decoder = decoder
@@ -0,0 +1,96 @@
+# Columnar (NumPy) implementation of the leaderboard fields that are plain
+# grouped reductions over Games: counts, and the best Game by some column.
+#
+# This is an optional backend for `aggregate --numpy`. NumPy isn't otherwise a
+# dependency, so nothing here may be used unless available() says so.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from datetime import timedelta
+
+# The LeaderboardBaseFields that grouped_reductions() computes. The rest
+# (unique deaths/ascs/achievements, streaks) need sets and stay in Python.
+COUNT_FIELDS = ['total_games', 'wins', 'games_over_1000_turns', 'games_scummed']
+BEST_GAME_FIELDS = ['min_score_asc', 'max_score_asc', 'lowest_turncount_asc',
+                    'fastest_realtime_asc', 'first_asc', 'max_conducts_asc',
+                    'max_achieves_game']
+REDUCTION_FIELDS = COUNT_FIELDS + BEST_GAME_FIELDS
+
+def available():
+    return np is not None
+
+# Turn GameRows (see the aggregate command) into a dict of parallel arrays,
+# one entry per game. is_scummed is the predicate deciding games_scummed.
+def game_columns(games, is_scummed):
+    games = list(games)
+    us = timedelta(microseconds=1)
+    return {
+        'id':            np.fromiter((g.id for g in games), np.int64, len(games)),
+        'player_id':     np.fromiter((g.player_id for g in games), np.int64, len(games)),
+        'won':           np.fromiter((g.won for g in games), np.bool_, len(games)),
+        'turns':         np.fromiter((g.turns for g in games), np.int64, len(games)),
+        'points':        np.fromiter((g.points for g in games), np.int64, len(games)),
+        'wallclock':     np.fromiter((g.wallclock // us for g in games), np.int64, len(games)),
+        'endtime':       np.fromiter((g.endtime.timestamp() for g in games), np.float64, len(games)),
+        'nconducts':     np.fromiter((g.nconducts for g in games), np.int64, len(games)),
+        'nachievements': np.fromiter((g.nachievements for g in games), np.int64, len(games)),
+        'scummed':       np.fromiter((is_scummed(g) for g in games), np.bool_, len(games)),
+    }
+
+# Compute REDUCTION_FIELDS for every group of games. groups is an array giving
+# the group (player or clan id) of each game in cols. Returns a dict mapping
+# each group to a dict of field values, where the best-game fields are Game
+# ids or None. As in the Python backend, ties go to the lowest Game id.
+def grouped_reductions(groups, cols):
+    keys, inv = np.unique(groups, return_inverse=True)
+    n = len(keys)
+    ids = cols['id']
+    won = cols['won']
+
+    def count(mask):
+        return np.bincount(inv[mask], minlength=n)
+
+    # Sort the games selected by mask on (group, key, id), and take the first
+    # game of each group: the one with the smallest key.
+    def first_by(mask, key):
+        idx = np.flatnonzero(mask)
+        order = idx[np.lexsort((ids[idx], key[idx], inv[idx]))]
+        grp = inv[order]
+        first = np.ones(len(order), np.bool_)
+        first[1:] = grp[1:] != grp[:-1]
+        best = np.full(n, -1, np.int64)
+        best[grp[first]] = ids[order[first]]
+        return best
+
+    everything = np.ones(len(ids), np.bool_)
+    results = {
+        'total_games':           count(everything),
+        'wins':                  count(won),
+        'games_over_1000_turns': count(cols['turns'] >= 1000),
+        'games_scummed':         count(cols['scummed']),
+        'min_score_asc':         first_by(won, cols['points']),
+        'max_score_asc':         first_by(won, -cols['points']),
+        'lowest_turncount_asc':  first_by(won, cols['turns']),
+        'fastest_realtime_asc':  first_by(won, cols['wallclock']),
+        'first_asc':             first_by(won, cols['endtime']),
+        'max_conducts_asc':      first_by(won, -cols['nconducts']),
+        'max_achieves_game':     first_by(everything, -cols['nachievements']),
+    }
+    results = { field: values.tolist() for field, values in results.items() }
+    reductions = {}
+    for i, key in enumerate(keys.tolist()):
+        red = { field: results[field][i] for field in COUNT_FIELDS }
+        for field in BEST_GAME_FIELDS:
+            red[field] = results[field][i] if results[field][i] >= 0 else None
+        reductions[key] = red
+    return reductions
+
+# Set the REDUCTION_FIELDS of a Player or Clan from one entry of
+# grouped_reductions() (None meaning it has no games).
+def apply_reductions(player_or_clan, reductions):
+    for field in COUNT_FIELDS:
+        setattr(player_or_clan, field, 0 if reductions is None else reductions[field])
+    for field in BEST_GAME_FIELDS:
+        setattr(player_or_clan, field + '_id', None if reductions is None else reductions[field])
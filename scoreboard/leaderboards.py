@@ -0,0 +1,77 @@
+# The leaderboards: what each one ranks players and clans by. The aggregate
+# command ranks everyone on each of them into LeaderboardEntry rows, and the
+# leaderboards page shows those rows in the order of LEADERBOARDS.
+#
+# A board either ranks a LeaderboardBaseFields count ('stat'), or one of the
+# best-game fields ('game'), in which case the stat is that Game's 'column' and
+# it links to the Game's dumplog. Ties are broken by who got to the stat first:
+# for a best game that is when the game ended, and for a count it is when the
+# game that brought it up to its current value ended.
+from django.utils import formats, timezone
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+# The order of these leaderboards determines the order on the page and in the
+# combo box.
+LEADERBOARDS = [
+    { 'id': 'mostasc', 'stat': 'wins', 'descending': True, 'wins_only': True,
+      'title': 'Most Ascensions', 'columntitle': 'wins' },
+    { 'id': 'firstasc', 'game': 'first_asc', 'column': 'endtime',
+      'descending': False, 'wins_only': True,
+      'title': 'Earliest Ascension', 'columntitle': 'time' },
+    { 'id': 'minturns', 'game': 'lowest_turncount_asc', 'column': 'turns',
+      'descending': False, 'wins_only': True,
+      'title': 'Lowest Turncount', 'columntitle': 'turns' },
+    { 'id': 'mintime', 'game': 'fastest_realtime_asc', 'column': 'wallclock',
+      'descending': False, 'wins_only': True,
+      'title': 'Fastest Realtime', 'columntitle': 'wallclock' },
+    { 'id': 'maxcond', 'game': 'max_conducts_asc', 'column': 'nconducts',
+      'descending': True, 'wins_only': True,
+      'title': 'Most Conducts in One Ascension', 'columntitle': 'conducts' },
+    { 'id': 'mostachgame', 'game': 'max_achieves_game', 'column': 'nachievements',
+      'descending': True, 'wins_only': False,
+      'title': 'Most Achievements in One Game', 'columntitle': 'achievements' },
+    { 'id': 'mostach', 'stat': 'unique_achievements', 'descending': True,
+      'wins_only': False,
+      'title': 'Most Achievements Overall', 'columntitle': 'achievements' },
+    { 'id': 'minscore', 'game': 'min_score_asc', 'column': 'points',
+      'descending': False, 'wins_only': True,
+      'title': 'Lowest Scoring Ascension', 'columntitle': 'points' },
+    { 'id': 'maxscore', 'game': 'max_score_asc', 'column': 'points',
+      'descending': True, 'wins_only': True,
+      'title': 'Highest Scoring Ascension', 'columntitle': 'points' },
+    { 'id': 'longstreak', 'stat': 'longest_streak', 'descending': True,
+      'wins_only': True,
+      'title': 'Longest Streak', 'columntitle': 'streak length' },
+    { 'id': 'uniquedeaths', 'stat': 'unique_deaths', 'descending': True,
+      'wins_only': False,
+      'title': 'Most Unique Deaths', 'columntitle': 'deaths' },
+    { 'id': 'uniqueasc', 'stat': 'unique_ascs', 'descending': True,
+      'wins_only': True,
+      'title': 'Most Unique Ascension Combos', 'columntitle': 'combos' },
+    { 'id': 'mostgames', 'stat': 'games_over_1000_turns', 'descending': True,
+      'wins_only': False,
+      'title': 'Most Games over 1000 Turns', 'columntitle': 'games' },
+]
+
+# The Game columns the 'game' boards need.
+GAME_COLUMNS = sorted(set(L['column'] for L in LEADERBOARDS if 'game' in L))
+
+# Turn a stat into the number LeaderboardEntry.value sorts it by.
+def sort_value(stat):
+    if isinstance(stat, datetime):
+        stat -= datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+    if isinstance(stat, timedelta):
+        return stat // timedelta(microseconds=1)
+    return int(stat)
+
+# Format a stat the way the template would have shown it.
+def format_stat(stat):
+    return str(formats.localize(timezone.template_localtime(stat)))
+
+# Sort key putting the entries of a board (objects with value, reached and
+# name) in rank order.
+def rank_key(descending):
+    def key(entry):
+        return (-entry.value if descending else entry.value,
+                entry.reached is None, entry.reached, entry.name)
+    return key
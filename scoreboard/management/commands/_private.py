@@ -0,0 +1,259 @@
+# Helpers shared between management commands. Not a command itself (Django
+# skips modules starting with an underscore).
+import django
+import random
+from datetime import datetime, timezone
+
+# Every role and the race/alignment combos it can be played as, following
+# NetHack 3.6. Valkyries are always female; everything else can be either
+# gender. This gives the 73 possible ascension combos.
+ROLE_RACE_ALIGNS = {
+    'Arc': [('Hum', 'Law'), ('Hum', 'Neu'), ('Dwa', 'Law'), ('Gno', 'Neu')],
+    'Bar': [('Hum', 'Neu'), ('Hum', 'Cha'), ('Orc', 'Cha')],
+    'Cav': [('Hum', 'Law'), ('Hum', 'Neu'), ('Dwa', 'Law'), ('Gno', 'Neu')],
+    'Hea': [('Hum', 'Neu'), ('Gno', 'Neu')],
+    'Kni': [('Hum', 'Law')],
+    'Mon': [('Hum', 'Law'), ('Hum', 'Neu'), ('Hum', 'Cha')],
+    'Pri': [('Hum', 'Law'), ('Hum', 'Neu'), ('Hum', 'Cha'), ('Elf', 'Cha')],
+    'Ran': [('Hum', 'Neu'), ('Hum', 'Cha'), ('Elf', 'Cha'), ('Gno', 'Neu'), ('Orc', 'Cha')],
+    'Rog': [('Hum', 'Cha'), ('Orc', 'Cha')],
+    'Sam': [('Hum', 'Law')],
+    'Tou': [('Hum', 'Neu')],
+    'Val': [('Hum', 'Law'), ('Hum', 'Neu'), ('Dwa', 'Law')],
+    'Wiz': [('Hum', 'Neu'), ('Hum', 'Cha'), ('Elf', 'Cha'), ('Gno', 'Neu'), ('Orc', 'Cha')],
+}
+
+# Things to die to, weighted towards the early game the way real xlogs are.
+# Several of them exercise the unique death normalizations in settings.
+EARLY_KILLERS = [
+    'jackal', 'fox', 'coyote', 'sewer rat', 'newt', 'grid bug', 'kobold',
+    'gnome', 'gnome lord', 'dwarf', 'hill orc', 'giant bat', 'giant ant',
+    'soldier ant', 'fire ant', 'rothe', 'homunculus', 'werejackal',
+    'water moccasin', 'small mimic', 'large mimic', 'iguana', 'little dog',
+    'kitten', 'gecko', 'acid blob', 'floating eye', 'dwarf lord', 'wolf',
+    'rabid rat', 'giant spider', 'leocrotta', 'white unicorn', 'watchman',
+]
+LATE_KILLERS = [
+    'troll', 'ettin', 'master mind flayer', 'mind flayer', 'purple worm',
+    'black dragon', 'green slime', 'cockatrice', 'chickatrice', 'lich',
+    'arch-lich', 'master lich', 'vampire lord', 'minotaur', 'titan',
+    'Olog-hai', 'storm giant', 'soldier', 'sergeant', 'captain',
+    'energy vortex', 'disenchanter', 'xorn', 'nalfeshnee', 'marilith',
+]
+OTHER_DEATHS = [
+    'killed by a falling rock', 'killed by a bolt of fire',
+    'killed by a bolt of cold', 'killed by a crossbow bolt',
+    'killed by an electric shock', 'killed by a wand', 'starved to death',
+    'drowned in a pool of water', 'turned to stone', 'died of starvation',
+    'choked on a lichen corpse', 'choked on a fortune cookie',
+    'killed by kicking a wall', 'killed by kicking a sink',
+    'poisoned by a rotted kobold corpse', 'poisoned by a rotted jackal corpse',
+    'killed by the wrath of Anhur', 'killed by the wrath of Tyr',
+    'killed by an Aleax of Mitra', 'killed by a water demon',
+    'killed by Mr. Asidonhopo, the shopkeeper',
+    'killed by Ms. Nosalnef, the shopkeeper',
+    'killed by the ghost of Pawel', 'killed by the priestess of Thoth',
+    'killed by the priest of Quetzalcoatl', 'killed by himself',
+    'killed by a hallucinogen-distorted jackal',
+    'killed by the invisible soldier ant', 'killed by an invisible stalker',
+]
+
+# Approximate distributions, roughly shaped after a real tournament.
+SCUM_RATE = 0.15        # games quit/escaped within the first 100 turns
+DEBUG_RATE = 0.005      # explore/wizmode games, which ingest discards
+OVERLAP_RATE = 0.03     # a player's next game starts before the last ended
+MAX_PARALLEL_RUNS = 20  # most servers a heavy player plays on at once
+
+class XlogGenerator:
+    # Generates synthetic tournament xlogfile lines.
+    # conducts and achievements are lists of (xlogfield, bit) pairs, normally
+    # taken from the Conduct and Achievement tables, which decide which bits
+    # the generated bitfields can have set.
+
+    def __init__(self, conducts, achievements, start, end, seed=0):
+        self.rng = random.Random(seed)
+        self.start = int(start.timestamp())
+        self.end = int(end.timestamp())
+        # per-conduct "how hard is it to keep" and per-achievement "how far
+        # into a game does it usually happen", fixed for the whole run
+        self.conducts = [ (field, bit, self.rng.uniform(0.05, 0.95))
+                          for field, bit in conducts ]
+        self.achievements = [ (field, bit, self.rng.random())
+                              for field, bit in achievements ]
+
+    # Return a list of xlog lines (without newlines) for nplayers players
+    # playing about ngames games in total, in endtime order.
+    def generate(self, nplayers, ngames):
+        rng = self.rng
+        names = [ 'player%05d' % i for i in range(nplayers) ]
+        # games per player is heavy-tailed: most play a few, some play a lot,
+        # but nobody plays more than fits in the tournament
+        weights = [ min(50, rng.paretovariate(1.2)) for _ in names ]
+        total = sum(weights)
+        games = []
+        for name, weight in zip(names, weights):
+            count = max(1, round(ngames * weight / total))
+            # most players rarely win; a few win a lot
+            skill = min(0.9, rng.betavariate(0.4, 6) * 3)
+            games.extend(self.player_games(name, count, skill))
+        games.sort(key=lambda g: g['endtime'])
+        return [ self.format_line(g) for g in games ]
+
+    # Generate count games by one player, mostly back to back. A player with
+    # more games than fit in the tournament one after another plays several
+    # at once on different servers, so once a run of games reaches the end of
+    # the tournament another one is started from a new random time.
+    def player_games(self, name, count, skill):
+        rng = self.rng
+        games = []
+        starttimes = set()
+        for _ in range(MAX_PARALLEL_RUNS):
+            t = rng.randrange(self.start, self.end)
+            # a player's games fill some share of the tournament
+            span = (self.end - t) / (count - len(games))
+            while len(games) < count:
+                g = self.game(name, skill)
+                g['starttime'] = t
+                g['endtime'] = t + g['wallclock']
+                if g['endtime'] > self.end:
+                    break
+                if t not in starttimes:
+                    starttimes.add(t)
+                    games.append(g)
+                if rng.random() < OVERLAP_RATE:
+                    # started on another server while this one was still going
+                    t = t + rng.randrange(1, max(2, g['wallclock']))
+                else:
+                    t = g['endtime'] + int(rng.expovariate(1 / max(60, span - g['wallclock'])))
+            if len(games) == count:
+                break
+        return games
+
+    # Generate a single game's fields, minus its start and end times.
+    def game(self, name, skill):
+        rng = self.rng
+        role = rng.choice(list(ROLE_RACE_ALIGNS))
+        race, align = rng.choice(ROLE_RACE_ALIGNS[role])
+        gender = 'Fem' if role == 'Val' else rng.choice(['Mal', 'Fem'])
+        g = { 'name': name, 'role': role, 'race': race, 'align': align,
+              'gender': gender, 'flags': 0x4, 'achieve': 0 }
+
+        if rng.random() < DEBUG_RATE:
+            g['flags'] |= rng.choice([0x1, 0x2])
+        if rng.random() < SCUM_RATE:
+            g['turns'] = rng.randrange(1, 101)
+            g['death'] = rng.choice(['quit', 'escaped'])
+            progress = 0.0
+        elif rng.random() < skill:
+            g['turns'] = int(rng.gauss(45000, 15000)) if rng.random() > 0.05 \
+                else rng.randrange(8000, 20000) # speedrunners
+            g['turns'] = max(5000, g['turns'])
+            g['death'] = 'ascended'
+            g['achieve'] |= (1 << 8) | 0xff # ascended, and all of the invocation items
+            progress = 1.0
+        else:
+            # how far a dying game got: mostly not far
+            progress = min(0.99, rng.expovariate(6))
+            g['turns'] = max(101, int(progress * 60000 * rng.uniform(0.5, 1.5)))
+            g['death'] = self.death(progress)
+
+        g['points'] = int(progress ** 2 * rng.uniform(500000, 4000000)) + g['turns'] * 5
+        if g['death'] == 'ascended' and rng.random() < 0.03:
+            g['points'] = rng.randrange(5000, 60000) # low-score ascension
+        g['maxlvl'] = max(1, int(progress * 50 + rng.uniform(0, 4)))
+        g['realtime'] = int(g['turns'] * rng.uniform(0.4, 2.5))
+        g['wallclock'] = g['realtime'] + int(rng.expovariate(1 / 600)) + 1
+
+        # conducts are kept (bit set) until broken; longer games break more
+        g['conduct'] = 0
+        for field, bit, keep in self.conducts:
+            if rng.random() < keep ** (g['turns'] / 2000):
+                g[field] = g.get(field, 0) | (1 << bit)
+        for field, bit, depth in self.achievements:
+            if rng.random() < (0.7 if depth < progress else 0.01):
+                g[field] = g.get(field, 0) | (1 << bit)
+        return g
+
+    def death(self, progress):
+        rng = self.rng
+        roll = rng.random()
+        if roll < 0.15:
+            return rng.choice(OTHER_DEATHS)
+        killer = rng.choice(LATE_KILLERS if progress > 0.3 else EARLY_KILLERS)
+        article = 'an' if killer[0] in 'aeiou' else 'a'
+        death = 'killed by %s %s' % (article, killer)
+        if roll > 0.95:
+            death += ', while helpless'
+        return death
+
+    def format_line(self, g):
+        rng = self.rng
+        day = lambda ts: datetime.fromtimestamp(ts, timezone.utc).strftime('%Y%m%d')
+        deathlev = max(1, g['maxlvl'] - rng.randrange(0, 3))
+        fields = [
+            ('server', 'bench.example.org'),
+            ('version', '3.6.6'),
+            ('points', g['points']),
+            ('deathdnum', rng.randrange(0, 8)),
+            ('deathlev', -5 if g['death'] == 'ascended' else deathlev),
+            ('maxlvl', g['maxlvl']),
+            ('hp', rng.randrange(100, 400) if g['death'] == 'ascended' else 0),
+            ('maxhp', rng.randrange(10, 400)),
+            ('deaths', 0 if g['death'] == 'ascended' else 1),
+            ('deathdate', day(g['endtime'])),
+            ('birthdate', day(g['starttime'])),
+            ('uid', 5),
+            ('role', g['role']),
+            ('race', g['race']),
+            ('gender', g['gender']),
+            ('align', g['align']),
+            ('name', g['name']),
+            ('death', g['death']),
+            ('conduct', hex(g['conduct'])),
+            ('turns', g['turns']),
+            ('achieve', hex(g['achieve'])),
+            ('realtime', g['realtime']),
+            ('starttime', g['starttime']),
+            ('endtime', g['endtime']),
+            ('gender0', g['gender']),
+            ('align0', g['align']),
+            ('flags', hex(g['flags'])),
+        ]
+        fields += [ ('tnntachieve%d' % i, hex(g.get('tnntachieve%d' % i, 0)))
+                    for i in range(5) ]
+        return '\t'.join('%s=%s' % (k, v) for k, v in fields)
+
+# Split players into clans of random sizes, roughly like the real thing: about
+# half of all players are in a clan, and clans have between 1 and max_size
+# members. Returns a list of lists of players; the first of each is the admin.
+def assign_clans(players, nclans, max_size, seed=0):
+    rng = random.Random(seed)
+    players = list(players)
+    rng.shuffle(players)
+    clans = []
+    pos = 0
+    for _ in range(nclans):
+        size = min(max_size, max(1, int(rng.expovariate(1 / 4)) + 1))
+        if pos + size > len(players):
+            break
+        clans.append(players[pos:pos + size])
+        pos += size
+    return clans
+
+# Initializer for spawned worker processes that use the database. It has to
+# live somewhere importable before Django is set up, which rules out the
+# command modules themselves. db_name points the worker at the same database
+# as the process that started it, which matters when that isn't the one in
+# settings (e.g. under the benchmark command's test database).
+def init_worker_process(db_name):
+    django.setup()
+    from django.db import connections
+    connections['default'].settings_dict['NAME'] = db_name
+
+# Initializer for worker processes that only parse xlog lines (see backfill).
+# They are handed the conducts and achievements decoder of the process that
+# started them, so that they never need the database for it.
+def init_parser_process(decoder):
+    django.setup()
+    from scoreboard import bitfields
+    bitfields.set_decoder(decoder)
@@ -1,11 +1,24 @@
 from django.core.management.base import BaseCommand
-from scoreboard.models import Source, Game, Player, Clan, Trophy, Achievement, Conduct
+from scoreboard.models import Source, Game, Player, Clan, Trophy, Achievement, Conduct, \
+    AggregationWatermark, AggregationRun, UniqueDeath, LeaderboardEntry, DataGeneration, \
+    SiteStats, RecentGame, BULK_BATCH_SIZE
 from scoreboard.parsers import XlogParser
-from django.db import transaction
-from django.db.models import Sum, Min, Max, Count
-from tnnt import uniqdeaths
+from scoreboard import bitfields, columnar, leaderboards
+from scoreboard.streaks import StreakTracker
+from tnnt import dumplog_utils
+from django.db import transaction, connection
+from django.db.models import Max, Q
+from django.utils import timezone
+from collections import defaultdict, namedtuple
+from datetime import datetime, timezone as dt_timezone
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from ._private import init_worker_process
+import multiprocessing
 import urllib
 import logging
+import cProfile
+import time
 
 logger = logging.getLogger() # root logger
 
@@ -13,17 +26,28 @@ logger = logging.getLogger() # root logger
 # these queries once when this module is loaded so that they don't have to be
 # hit multiple times in loops.
 TOTAL_ACHIEVEMENTS = Achievement.objects.count()
-TOTAL_CONDUCTS = Conduct.objects.count()
 TROPHIES = { tr.name: tr for tr in Trophy.objects.all() }
+CONDUCT_SHORTNAMES = dict(Conduct.objects.values_list('id', 'shortname'))
+# where each Conduct is in GameRow.bits, and all the Achievement bits there
+CONDUCT_BITS = bitfields.get_decoder().conducts.packed_bits
+ACHIEVEMENT_MASK = bitfields.get_decoder().achievements.packed_mask
+
+# The LeaderboardBaseFields that aggregation computes and bulk-writes.
+LEADERBOARD_FIELDS = ['longest_streak', 'unique_deaths', 'unique_ascs', 'unique_achievements',
+                      'games_over_1000_turns', 'games_scummed', 'total_games', 'wins',
+                      'lowest_turncount_asc', 'fastest_realtime_asc', 'max_conducts_asc',
+                      'max_achieves_game', 'min_score_asc', 'max_score_asc', 'first_asc']
 
 # These are determined by NetHack and there's no expectation that TNNT would
 # ever change them. However, they may need to change if changes are made to
 # vanilla NetHack which are then incorporated into TNNT (for instance, if the
 # DevTeam adds a new role).
-TOTAL_GENDERS = 2
-TOTAL_ALIGNMENTS = 3
-TOTAL_RACES = 5
-TOTAL_ROLES = 13
+# The lists are the codes as they appear in Games, in the order used for
+# TrophyEvaluator's bitsets.
+GENDERS = ['Mal', 'Fem']
+ALIGNS = ['Law', 'Neu', 'Cha']
+RACES = ['Hum', 'Dwa', 'Elf', 'Gno', 'Orc']
+ROLES = ['Arc', 'Bar', 'Cav', 'Hea', 'Kni', 'Mon', 'Pri', 'Ran', 'Rog', 'Sam', 'Tou', 'Val', 'Wiz']
 TOTAL_POSSIBLE_COMBOS = 73
 great_lesser_race = {
     'Dwarf': { 'race': 'Dwa', 'req_roles': set(['Arc','Cav','Val']) },
@@ -75,274 +99,804 @@ great_lesser_role = {
     },
 }
 
-# Determine and award trophies to a player or clan.
-# ASSUMPTION: The player's LeaderboardBaseFields are already computed.
-# allgames_qs is a QuerySet of all Games by this player/clan. For most
-# operations, we convert this to a list to avoid thrashing the database too
-# much, while keeping the queryset around for the few things that need it. (I'm
-# not totally sure if this would actually do that with repeated queries, but I
-# suspect it would.)
-# IMPORTANT: Nothing in here should use gender or align! gender0 and align0 only!
-def awardTrophies(player_or_clan, allgames_qs):
-    # First, a small optimization: exclude all games that are neither ascensions
-    # nor have mines/soko complete. These won't contribute to any trophies.
-    # (Never Scum a Game is based off the precomputed games_scummed.)
-    allgames = [ g for g in allgames_qs.all() if g.won or g.mines_soko ]
-
-    # It might be possible to optimize some of this by doing a big, single pass
-    # through allgames and storing various bits of data in sets, but there
-    # currently isn't a demonstrated need for this.
-
-    # Great Race
-    for fullrace, details in great_lesser_race.items():
-        # Compute all distinct roles for which there exists a winning game
-        # that has this race. If the trophy required set is a subset of it,
-        # award it.
-        # This uses a subset operation because the player's human ascensions can
-        # be a larger set than what is required for Great Human. (I.e. it
-        # shouldn't be assumed that the requisite lists above contain every
-        # possible ascendable combination in NetHack, which also goes for Great
-        # Role.)
-        if details['req_roles'].issubset(set(g.role for g in allgames
-                                         if g.won and g.race == details['race'])):
-            player_or_clan.trophies.add(TROPHIES['Great %s' % fullrace])
-
-        # Then the same for mines_soko games.
-        if details['req_roles'].issubset(set(g.role for g in allgames
-                                         if g.mines_soko and g.race == details['race'])):
-            player_or_clan.trophies.add(TROPHIES['Lesser %s' % fullrace])
-
-    # Great Role
-    for fullrole, details in great_lesser_role.items():
-        # Similar to above. Compute distinct race-align combos.
-        if details['req_race_algn'].issubset(set('%s-%s' % (g.race, g.align0) for g in allgames
-                                             if g.won and g.role == details['role'])):
-            player_or_clan.trophies.add(TROPHIES['Great %s' % fullrole])
-
-        # And the same for mines_soko.
-        if details['req_race_algn'].issubset(set('%s-%s' % (g.race, g.align0) for g in allgames
-                                             if g.mines_soko and g.role == details['role'])):
-            player_or_clan.trophies.add(TROPHIES['Lesser %s' % fullrole])
-
-    # All Foo
-    if len(set(g.gender0 for g in allgames if g.won)) == TOTAL_GENDERS:
-        player_or_clan.trophies.add(TROPHIES['Both Genders'])
-    if len(set(g.align0 for g in allgames if g.won)) == TOTAL_ALIGNMENTS:
-        player_or_clan.trophies.add(TROPHIES['All Alignments'])
-    if len(set(g.race for g in allgames if g.won)) == TOTAL_RACES:
-        player_or_clan.trophies.add(TROPHIES['All Races'])
-    if len(set(g.role for g in allgames if g.won)) == TOTAL_ROLES:
-        player_or_clan.trophies.add(TROPHIES['All Roles'])
-    if player_or_clan.unique_achievements == TOTAL_ACHIEVEMENTS:
-        player_or_clan.trophies.add(TROPHIES['All Achievements'])
-    # All Conducts kind of has to be a query, since we don't track "number of
-    # discrete conducts across all games" on a leaderboard.
-    unique_conducts = allgames_qs.filter(won=True) \
-        .aggregate(Count('conducts__id', distinct=True)) \
-        ['conducts__id__count']
-    if unique_conducts == TOTAL_CONDUCTS:
-        player_or_clan.trophies.add(TROPHIES['All Conducts'])
-    if player_or_clan.unique_ascs == TOTAL_POSSIBLE_COMBOS:
-        player_or_clan.trophies.add(TROPHIES['NetHack Master'])
-        if unique_conducts == TOTAL_CONDUCTS:
-            player_or_clan.trophies.add(TROPHIES['NetHack Dominator'])
-
-    # Never Scum a Game is a weird trophy in that a player has it by default,
-    # and can lose it at a later point.
-    try:
-        nsag = player_or_clan.trophies.get(name='Never Scum a Game')
-        if player_or_clan.games_scummed > 0:
-            player_or_clan.trophies.remove(nsag)
-    except Trophy.DoesNotExist:
+# Bit numbers of each role-race-align0 combination, and of each gender0.
+COMBO_BITS = { (role, race, align): (i * len(RACES) + j) * len(ALIGNS) + k
+               for i, role in enumerate(ROLES)
+               for j, race in enumerate(RACES)
+               for k, align in enumerate(ALIGNS) }
+GENDER_BITS = { gender: i for i, gender in enumerate(GENDERS) }
+
+# Mask of every combo bit matching the given role, race and/or align (None
+# meaning any).
+def comboMask(role=None, race=None, align=None):
+    mask = 0
+    for (crole, crace, calign), bit in COMBO_BITS.items():
+        if role in (None, crole) and race in (None, crace) and align in (None, calign):
+            mask |= 1 << bit
+    return mask
+
+class TrophyEvaluator:
+    # Decides which trophies a player or clan has. Games are first reduced to
+    # a few bitsets - the role-race-align0 combos ascended, those with
+    # Mines/Sokoban done, the gender0s ascended, and the union of conducts
+    # kept in ascensions - and most trophies are then a list of masks which
+    # must each share a bit with one of those bitsets.
+    # IMPORTANT: Nothing in here should use gender or align! gender0 and align0 only!
+
+    def __init__(self, trophies, conduct_shortnames, conduct_bits):
+        # trophies maps trophy names to Trophies, conduct_shortnames maps
+        # Conduct ids to shortnames, and conduct_bits maps them to their bits
+        # in GameRow.bits
+        self.trophy_ids = { name: tr.id for name, tr in trophies.items() }
+        conduct_masks = { shortname: conduct_bits[cid]
+                          for cid, shortname in conduct_shortnames.items() }
+        self.all_conducts = 0
+        for mask in conduct_masks.values():
+            self.all_conducts |= mask
+
+        # (trophy name, 'won' or 'soko', list of combo masks)
+        self.combo_rules = []
+        for fullrace, details in great_lesser_race.items():
+            # Every required role must have been done as this race, in any
+            # alignment. (The requisite lists shouldn't be assumed to contain
+            # every possible ascendable combination in NetHack, which also goes
+            # for Great Role.)
+            masks = [ comboMask(role=role, race=details['race']) for role in details['req_roles'] ]
+            self.combo_rules.append(('Great %s' % fullrace, 'won', masks))
+            self.combo_rules.append(('Lesser %s' % fullrace, 'soko', masks))
+        for fullrole, details in great_lesser_role.items():
+            # Every required race-align combo must have been done as this role.
+            masks = [ comboMask(role=details['role'], race=race_algn[:3], align=race_algn[4:])
+                      for race_algn in details['req_race_algn'] ]
+            self.combo_rules.append(('Great %s' % fullrole, 'won', masks))
+            self.combo_rules.append(('Lesser %s' % fullrole, 'soko', masks))
+        # All Foo
+        self.combo_rules.append(('All Alignments', 'won', [ comboMask(align=a) for a in ALIGNS ]))
+        self.combo_rules.append(('All Races', 'won', [ comboMask(race=r) for r in RACES ]))
+        self.combo_rules.append(('All Roles', 'won', [ comboMask(role=r) for r in ROLES ]))
+
+        # Never Kill Foo: (trophy name, conduct mask)
+        self.conduct_rules = [ (name, conduct_masks[shortname]) for shortname, name in [
+            ('neme', 'Never Kill the Quest Nemesis'),
+            ('vlad', 'Never Kill Vlad'),
+            ('wiz',  'Never Kill Rodney'),
+            ('prst', 'Never Kill the High Priest of Moloch'),
+            ('ride', 'Never Kill a Rider'),
+        ] if shortname in conduct_masks ]
+
+    # Reduce a list of GameRows to the bitsets the trophy rules look at, as a
+    # tuple of (won combos, mines/soko combos, won gender0s, won conducts).
+    def reduce(self, allgames):
+        won = soko = genders = conducts = 0
+        for g in allgames:
+            if not (g.won or g.mines_soko):
+                continue
+            bit = COMBO_BITS.get((g.role, g.race, g.align0))
+            combo = 0 if bit is None else 1 << bit
+            if g.won:
+                won |= combo
+                if g.gender0 in GENDER_BITS:
+                    genders |= 1 << GENDER_BITS[g.gender0]
+                conducts |= g.bits
+            if g.mines_soko:
+                soko |= combo
+        return (won, soko, genders, conducts & self.all_conducts)
+
+    # Combine the reduce() results of several players into a clan's.
+    @staticmethod
+    def merge(bitsets):
+        won = soko = genders = conducts = 0
+        for w, s, g, c in bitsets:
+            won |= w
+            soko |= s
+            genders |= g
+            conducts |= c
+        return (won, soko, genders, conducts)
+
+    # Return the set of Trophy ids player_or_clan should have, given the
+    # reduce()d bitsets of all its games.
+    # ASSUMPTION: The player's LeaderboardBaseFields are already computed.
+    def evaluate(self, player_or_clan, bitsets):
+        won, soko, genders, conducts = bitsets
+        by_kind = { 'won': won, 'soko': soko }
+
+        earned = []
+        for name, which, masks in self.combo_rules:
+            if all(by_kind[which] & mask for mask in masks):
+                earned.append(name)
+        if genders == (1 << len(GENDERS)) - 1:
+            earned.append('Both Genders')
+        if player_or_clan.unique_achievements == TOTAL_ACHIEVEMENTS:
+            earned.append('All Achievements')
+        all_conducts = conducts == self.all_conducts
+        if all_conducts:
+            earned.append('All Conducts')
+        if player_or_clan.unique_ascs == TOTAL_POSSIBLE_COMBOS:
+            earned.append('NetHack Master')
+            if all_conducts:
+                earned.append('NetHack Dominator')
+        # Never Scum a Game is a weird trophy in that a player has it by
+        # default, and can lose it at a later point.
         if player_or_clan.total_games > 0 and player_or_clan.games_scummed == 0:
-            player_or_clan.trophies.add(TROPHIES['Never Scum a Game'])
-
-    # Never Kill Foo
-    for g in allgames_qs.filter(won=True).prefetch_related('conducts'):
-        for c in g.conducts.all():
-            if c.shortname == 'neme':
-                player_or_clan.trophies.add(TROPHIES['Never Kill the Quest Nemesis'])
-            elif c.shortname == 'vlad':
-                player_or_clan.trophies.add(TROPHIES['Never Kill Vlad'])
-            elif c.shortname == 'wiz':
-                player_or_clan.trophies.add(TROPHIES['Never Kill Rodney'])
-            elif c.shortname == 'prst':
-                player_or_clan.trophies.add(TROPHIES['Never Kill the High Priest of Moloch'])
-            elif c.shortname == 'ride':
-                player_or_clan.trophies.add(TROPHIES['Never Kill a Rider'])
-
-
-# Compute LeaderboardBaseFields data on all Players, and write it back.
-def aggregatePlayerData():
-    for plr in Player.objects.all():
-        # all of the below only consider games done by this player
-        gamesby_plr = Game.objects.filter(player=plr)
-        # and a number of them only consider *ascended* games
-        winsby_plr = gamesby_plr.filter(won=True)
-
-        # simple aggregates (game counts)
-        plr.total_games = gamesby_plr.count()
-        plr.wins = winsby_plr.count()
-        plr.games_over_1000_turns = gamesby_plr.filter(turns__gte=1000).count()
-        # This is the source of truth for "what is a scummed game".
-        plr.games_scummed = gamesby_plr.filter(
-            death__in=('quit','escaped'),
-            turns__lte=100).count()
-
-        # a more complex aggregate
-        # different from max_achieves_game; this is the total number of
-        # distinct achievements across all games
-        plr.unique_achievements = \
-                gamesby_plr.aggregate(Count('achievements__id', distinct=True)) \
-                ['achievements__id__count']
-
-        # Unique deaths are more complex, but that's outsourced to another
-        # module, so just get the set of unique deaths and take the length.
-        plr.unique_deaths = len(uniqdeaths.compile_unique_deaths(gamesby_plr))
-
-        # Unique ascs are a one-liner.
-        plr.unique_ascs = len(set(g.rrga() for g in winsby_plr))
-
-        # Streaks are computed on their own as well.
-        streak_lengths = list(map(lambda s: len(s.games), plr.get_streaks()))
-        if len(streak_lengths) == 0:
-            plr.longest_streak = 0
+            earned.append('Never Scum a Game')
+        for name, mask in self.conduct_rules:
+            if conducts & mask:
+                earned.append(name)
+        return set(self.trophy_ids[name] for name in earned)
+
+TROPHY_EVALUATOR = TrophyEvaluator(TROPHIES, CONDUCT_SHORTNAMES, CONDUCT_BITS)
+
+# Bring the trophies of a set of Players or Clans (model is one or the other)
+# in line with trophies, a dict mapping their ids to sets of Trophy ids. Only
+# the difference from what is already there gets written: one query to read
+# the existing rows, one delete and one bulk insert.
+def writeTrophies(model, trophies):
+    through = model.trophies.through
+    owner = model._meta.model_name + '_id'
+    to_delete = []
+    missing = { owner_id: set(trophy_ids) for owner_id, trophy_ids in trophies.items() }
+    for row_id, owner_id, trophy_id in through.objects \
+            .filter(**{ owner + '__in': list(trophies) }) \
+            .values_list('id', owner, 'trophy_id'):
+        if trophy_id in missing[owner_id]:
+            missing[owner_id].remove(trophy_id)
+        else:
+            to_delete.append(row_id)
+    if len(to_delete) > 0:
+        through.objects.filter(id__in=to_delete).delete()
+    through.objects.bulk_create(
+        [ through(**{ owner: owner_id, 'trophy_id': trophy_id })
+          for owner_id, trophy_ids in missing.items() for trophy_id in trophy_ids ],
+        batch_size=BULK_BATCH_SIZE)
+
+# How many of the slowest players and clans to compute an aggregate run
+# reports.
+AGGREGATE_SLOWEST = 10
+
+class SQLTimer:
+    # execute_wrapper that counts the queries run through it and the time
+    # spent in them
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.perf_counter() - start
+
+class AggregationStats:
+    # Instrumentation for one aggregate run: for each phase, the wall-clock
+    # time, number of queries and time spent in SQL; running totals for a few
+    # hot spots inside the phases (timers); and how long each player and clan
+    # took to compute.
+    def __init__(self):
+        self.phases = {}               # name -> [seconds, queries, sql seconds]
+        self.timers = defaultdict(float)
+        self.player_times = {}         # player name -> seconds
+        self.clan_times = {}           # clan name -> seconds
+
+    # Time the body as the named phase. A phase that runs more than once is
+    # added up.
+    @contextmanager
+    def phase(self, name):
+        sql = SQLTimer()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(sql):
+                yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start, sql.queries, sql.seconds)
+
+    def add_phase(self, name, seconds, queries, sql_seconds):
+        totals = self.phases.setdefault(name, [0.0, 0, 0.0])
+        totals[0] += seconds
+        totals[1] += queries
+        totals[2] += sql_seconds
+
+    # Add in the stats of a worker process, with its phases and timers under
+    # prefix.
+    def merge(self, other, prefix):
+        for name, totals in other.phases.items():
+            self.add_phase(prefix + name, *totals)
+        for name, seconds in other.timers.items():
+            self.timers[prefix + name] += seconds
+        self.player_times.update(other.player_times)
+        self.clan_times.update(other.clan_times)
+
+    # Return everything as something JSON-serializable.
+    def report(self, slowest=AGGREGATE_SLOWEST):
+        def top(times):
+            return sorted(times.items(), key=lambda t: t[1], reverse=True)[:slowest]
+        return {
+            'phases': [ { 'name': name, 'seconds': seconds, 'queries': queries,
+                          'sql_seconds': sql_seconds }
+                        for name, (seconds, queries, sql_seconds) in self.phases.items() ],
+            'timers': dict(self.timers),
+            'slowest_players': top(self.player_times),
+            'slowest_clans': top(self.clan_times),
+        }
+
+# A Game as aggregation sees it: the handful of columns it needs, with its
+# bitfields pack()ed into one int (bits), without the overhead of a model
+# instance. db_fields are read straight from the Game table.
+class GameRow(namedtuple('GameRow', ['id', 'player_id', 'won', 'mines_soko', 'turns',
+                                     'points', 'wallclock', 'starttime', 'endtime',
+                                     'death', 'normalized_death_id', 'role', 'race',
+                                     'gender0', 'align0', 'nconducts', 'nachievements',
+                                     'bits'])):
+    __slots__ = ()
+    db_fields = ('id', 'player_id', 'won', 'mines_soko', 'turns', 'points', 'wallclock',
+                 'starttime', 'endtime', 'death', 'normalized_death_id', 'role', 'race',
+                 'gender0', 'align0', 'nconducts', 'nachievements') \
+        + tuple(bitfields.GAME_BITFIELDS)
+
+    # same as Game.rrga()
+    def rrga(self):
+        return '-'.join([self.role, self.race, self.gender0, self.align0])
+
+# Fetch the Games in game_qs in one query, and return them as lists of
+# GameRows keyed by player id. Each list is in starttime order.
+def loadGameRows(game_qs):
+    rows = defaultdict(list)
+    nfields = len(GameRow.db_fields) - len(bitfields.GAME_BITFIELDS)
+    for row in game_qs.order_by('starttime', 'id').values_list(*GameRow.db_fields):
+        rows[row[1]].append(GameRow(*row[:nfields], bitfields.pack(row[nfields:])))
+    return rows
+
+# This is the source of truth for "what is a scummed game".
+def isScummed(game):
+    return game.death in ('quit', 'escaped') and game.turns <= 100
+
+# The best-game LeaderboardBaseFields: the field, whether only ascensions
+# count, and the key the best game has the smallest of. Ties go to the
+# earliest Game (lowest id).
+BEST_GAMES = [
+    ('min_score_asc',        True,  lambda g: (g.points, g.id)),
+    ('max_score_asc',        True,  lambda g: (-g.points, g.id)),
+    ('lowest_turncount_asc', True,  lambda g: (g.turns, g.id)),
+    ('fastest_realtime_asc', True,  lambda g: (g.wallclock, g.id)),
+    ('first_asc',            True,  lambda g: (g.endtime, g.id)),
+    # post 2021 TODO: Should this exclude some TNNT-added conducts?
+    ('max_conducts_asc',     True,  lambda g: (-g.nconducts, g.id)),
+    ('max_achieves_game',    False, lambda g: (-g.nachievements, g.id)),
+]
+
+class AggregateResult:
+    # What aggregating a player leaves behind besides its fields: the things
+    # a clan's fields are built from by merging its members'.
+
+    def __init__(self, achievements, deaths, ascs, best, trophy_bits, reached):
+        # the first three map each distinct thing done to the endtime of the
+        # first game that did it
+        self.achievements = achievements # achievement bit (in GameRow.bits)
+        self.deaths = deaths             # unique Death id
+        self.ascs = ascs                 # rrga() string ascended
+        self.best = best                 # BEST_GAMES field -> GameRow or None
+        self.trophy_bits = trophy_bits   # TrophyEvaluator.reduce() result
+        # LeaderboardBaseFields count -> endtime of the game that brought it up
+        # to its current value, or None; see scoreboard.leaderboards
+        self.reached = reached
+
+    # Combine the results of a clan's members. The reached time of the clan's
+    # longest_streak depends on which members' streak is the longest, so it
+    # is left to the caller.
+    @classmethod
+    def merge(cls, results):
+        results = list(results)
+        best = {}
+        for field, _, key in BEST_GAMES:
+            best[field] = min((r.best[field] for r in results if r.best[field] is not None),
+                              key=key, default=None)
+        firsts = []
+        for attr in ('achievements', 'deaths', 'ascs'):
+            first = {}
+            for r in results:
+                for thing, endtime in getattr(r, attr).items():
+                    if thing not in first or endtime < first[thing]:
+                        first[thing] = endtime
+            firsts.append(first)
+        achievements, deaths, ascs = firsts
+        # a clan's count went up whenever one of its members' did
+        reached = { field: max((r.reached[field] for r in results
+                                if r.reached[field] is not None), default=None)
+                    for field in ('wins', 'games_over_1000_turns') }
+        reached.update(lastReached(achievements, deaths, ascs))
+        return cls(achievements, deaths, ascs, best,
+                   TrophyEvaluator.merge(r.trophy_bits for r in results), reached)
+
+# The reached times of the unique_* counts: when the last of the distinct
+# things counted was first done.
+def lastReached(achievements, deaths, ascs):
+    return {
+        'unique_achievements': max(achievements.values(), default=None),
+        'unique_deaths':       max(deaths.values(), default=None),
+        'unique_ascs':         max(ascs.values(), default=None),
+    }
+
+# Compute plr's LeaderboardBaseFields from its games (a list of GameRows in
+# starttime order), without saving, and return its AggregateResult. With
+# best_games=False the best-game fields are left alone (and missing from the
+# result), for when the columnar backend computes them. With resume_streaks,
+# streaks carry on from plr's saved streak state where possible. Time spent on
+# streaks is added to stats, if given.
+def computePlayerFields(plr, games, best_games=True, resume_streaks=False, stats=None):
+    # simple aggregates (game counts), and the things the player has done
+    # along with when they first did them, all in a single pass over the
+    # games in the order they ended
+    wins = []
+    plr.games_over_1000_turns = 0
+    plr.games_scummed = 0
+    reached = { 'wins': None, 'games_over_1000_turns': None }
+    # different from max_achieves_game; this is the union of all the games'
+    # achievements
+    achieved_bits = 0
+    achievements = {}
+    deaths = {}
+    ascs = {}
+    for g in sorted(games, key=lambda g: g.endtime):
+        if g.won:
+            wins.append(g)
+            reached['wins'] = g.endtime
+            ascs.setdefault(g.rrga(), g.endtime)
+        if g.turns >= 1000:
+            plr.games_over_1000_turns += 1
+            reached['games_over_1000_turns'] = g.endtime
+        if isScummed(g):
+            plr.games_scummed += 1
+        new_bits = g.bits & ACHIEVEMENT_MASK & ~achieved_bits
+        if new_bits:
+            achieved_bits |= new_bits
+            while new_bits:
+                bit = new_bits & -new_bits
+                achievements[bit] = g.endtime
+                new_bits ^= bit
+        # Unique deaths were normalized at ingest (see Game.normalized_death),
+        # so the Death ids are all there is to it.
+        if g.normalized_death_id is not None:
+            deaths.setdefault(g.normalized_death_id, g.endtime)
+    plr.total_games = len(games)
+    plr.wins = len(wins)
+    plr.unique_achievements = len(achievements)
+    plr.unique_deaths = len(deaths)
+    plr.unique_ascs = len(ascs)
+    reached.update(lastReached(achievements, deaths, ascs))
+
+    # Streaks are computed on their own.
+    start = time.perf_counter()
+    tracker = StreakTracker.resume(plr.streak_state if resume_streaks else None, games)
+    plr.longest_streak = tracker.longest
+    plr.streak_state = tracker.state()
+    reached['longest_streak'] = None if tracker.longest_at is None \
+        else datetime.fromtimestamp(tracker.longest_at, dt_timezone.utc)
+    if stats is not None:
+        stats.timers['streaks'] += time.perf_counter() - start
+
+    # From here on, this is less about aggregating into one result, and more
+    # about taking the game which is the player's best in some statistic.
+    best = {}
+    if best_games:
+        for field, wins_only, key in BEST_GAMES:
+            best[field] = min(wins if wins_only else games, key=key, default=None)
+            setattr(plr, field + '_id', None if best[field] is None else best[field].id)
+
+    return AggregateResult(achievements, deaths, ascs, best,
+                           TROPHY_EVALUATOR.reduce(games), reached)
+
+# Compute LeaderboardBaseFields data on the given Players from the Games in
+# game_qs, without writing anything. Returns a dict mapping their ids to their
+# AggregateResults, and one mapping them to the ids of their trophies.
+# resume_streaks carries on from each Player's saved streak state rather than
+# going through all their games again. With use_numpy, the counts and best
+# games come from the columnar backend. Timings go into stats.
+def computePlayerData(players, game_qs, stats, resume_streaks=False, use_numpy=False):
+    with stats.phase('load player games'):
+        rows = loadGameRows(game_qs)
+    if use_numpy:
+        with stats.phase('numpy reductions'):
+            cols = columnar.game_columns((g for games in rows.values() for g in games), isScummed)
+            reductions = columnar.grouped_reductions(cols['player_id'], cols)
+    results = {}
+    trophies = {}
+    with stats.phase('compute players'):
+        for plr in players:
+            start = time.perf_counter()
+            games = rows.get(plr.id, [])
+            result = computePlayerFields(plr, games, best_games=not use_numpy,
+                                         resume_streaks=resume_streaks, stats=stats)
+            if use_numpy:
+                columnar.apply_reductions(plr, reductions.get(plr.id))
+                by_id = { g.id: g for g in games }
+                result.best = { field: by_id.get(getattr(plr, field + '_id'))
+                                for field, _, _ in BEST_GAMES }
+            results[plr.id] = result
+            trophy_start = time.perf_counter()
+            trophies[plr.id] = TROPHY_EVALUATOR.evaluate(plr, result.trophy_bits)
+            end = time.perf_counter()
+            stats.timers['player trophies'] += end - trophy_start
+            stats.player_times[plr.name] = end - start
+    return results, trophies
+
+# Worker process: computePlayerData for one shard of the players, returning
+# the updated Players along with its results.
+def aggregatePlayerShard(plr_ids, resume_streaks, use_numpy):
+    stats = AggregationStats()
+    players = list(Player.objects.filter(id__in=plr_ids))
+    results, trophies = computePlayerData(players, Game.objects.filter(player__in=plr_ids),
+                                          stats, resume_streaks, use_numpy)
+    return players, results, trophies, stats
+
+# Compute LeaderboardBaseFields data on the given Players (default: all of
+# them), and write it back. Returns a dict mapping their ids to their
+# AggregateResults.
+# All the Games involved are fetched up front and the results written with a
+# bulk update, so the number of queries doesn't grow with the number of
+# players.
+# all_players says that players is every Player, so there's no need to filter
+# Games by player; it also makes this a full run, which recomputes streaks
+# from scratch rather than resuming them. With use_numpy, the counts and best
+# games come from the columnar backend.
+# With more than one worker, the players are split into that many shards by
+# id, which are computed in parallel in separate processes with their own
+# database connections. Only the computing is spread out: the writes all
+# happen here, in the caller's transaction. The workers are spawned rather
+# than forked so that none of them shares this process's connection, which is
+# in the middle of that transaction.
+# Timings go into stats, if given; the workers' ones are prefixed with "shard".
+def aggregatePlayerData(players=None, all_players=False, use_numpy=False, workers=1,
+                        stats=None):
+    if stats is None:
+        stats = AggregationStats()
+    if players is None:
+        players = list(Player.objects.all())
+        all_players = True
+    if workers > 1:
+        shards = [ [ plr.id for plr in players if plr.id % workers == i ]
+                   for i in range(workers) ]
+        results = {}
+        trophies = {}
+        players = []
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_worker_process,
+                                 initargs=(connection.settings_dict['NAME'],)) as pool:
+            with stats.phase('compute player shards'):
+                for i, (shard_players, shard_results, shard_trophies, shard_stats) in \
+                        enumerate(pool.map(aggregatePlayerShard, shards,
+                                           [ not all_players ] * workers, [ use_numpy ] * workers)):
+                    players.extend(shard_players)
+                    results.update(shard_results)
+                    trophies.update(shard_trophies)
+                    stats.merge(shard_stats, 'shard %d: ' % i)
+    else:
+        if all_players:
+            game_qs = Game.objects.all()
         else:
-            plr.longest_streak = max(streak_lengths)
-
-        # From here on, this is less about aggregating into one result, and more
-        # about taking the game which is the player's best in some statistic.
-        # Skip this if the player has no games, and for most of them, if the
-        # player has no wins.
-        if plr.total_games > 0:
-            if plr.wins > 0:
-                plr.min_score_asc = winsby_plr.order_by('points')[0]
-                plr.max_score_asc = winsby_plr.order_by('-points')[0]
-                plr.lowest_turncount_asc = winsby_plr.order_by('turns')[0]
-                plr.fastest_realtime_asc = winsby_plr.order_by('wallclock')[0]
-                plr.first_asc = winsby_plr.earliest('endtime')
-
-            # These two are also Games which are the player's best in a
-            # statistic, but require a bit more complex of a query.
-            plr.max_achieves_game = \
-                gamesby_plr.annotate(nachieve=Count('achievements__id', distinct=True)) \
-                .order_by('-nachieve')[0]
-            # post 2021 TODO: Should this exclude some TNNT-added conducts?
-            if plr.wins > 0:
-                plr.max_conducts_asc = \
-                    winsby_plr.annotate(ncond=Count('conducts__id', distinct=True)) \
-                    .order_by('-ncond')[0]
-
-        plr.save()
-        awardTrophies(plr, gamesby_plr)
+            game_qs = Game.objects.filter(player__in=[ plr.id for plr in players ])
+        results, trophies = computePlayerData(players, game_qs, stats,
+                                              resume_streaks=not all_players,
+                                              use_numpy=use_numpy)
+    with stats.phase('write players'):
+        Player.objects.bulk_update(players, LEADERBOARD_FIELDS + ['streak_state'],
+                                   batch_size=BULK_BATCH_SIZE)
+        writeTrophies(Player, trophies)
     logging.info('aggregatePlayerData complete')
-
-# Compute LeaderboardBaseFields data on all Clans, and write it back.
+    return results
+
+# Compute LeaderboardBaseFields data on the given Clans (default: all of them),
+# and write it back. Returns a dict mapping their ids to their merged
+# AggregateResults.
+# Everything is merged from the members' Player fields and AggregateResults,
+# so nothing is queried per clan. results is what aggregatePlayerData
+# returned in this run; members it doesn't cover (e.g. when an incremental run
+# only recomputed some of a clan's members) have theirs worked out here.
 # ASSUMPTION: It is run after aggregatePlayerData is run, and that each Player
 # has had its leaderboard base fields updated.
-def aggregateClanData():
-    for clan in Clan.objects.all():
-        clan_plrs = Player.objects.filter(clan=clan)
+# Timings go into stats, if given.
+def aggregateClanData(clans=None, results=None, stats=None):
+    if stats is None:
+        stats = AggregationStats()
+    if clans is None:
+        clans = list(Clan.objects.all())
+    if results is None:
+        results = {}
+    with stats.phase('load clan members'):
+        members = defaultdict(list)
+        missing = []
+        for plr in Player.objects.filter(clan__in=clans):
+            members[plr.clan_id].append(plr)
+            if plr.id not in results:
+                missing.append(plr)
+        if len(missing) > 0:
+            # Their stored fields are already up to date, so only the results
+            # are wanted; the Players themselves aren't saved.
+            rows = loadGameRows(Game.objects.filter(player__in=[ plr.id for plr in missing ]))
+            for plr in missing:
+                results[plr.id] = computePlayerFields(plr, rows.get(plr.id, []),
+                                                      resume_streaks=True, stats=stats)
+
+    with stats.phase('compute clans'):
+        clan_trophies, clan_results = computeClanFields(clans, members, results, stats)
+    with stats.phase('write clans'):
+        Clan.objects.bulk_update(clans, LEADERBOARD_FIELDS, batch_size=BULK_BATCH_SIZE)
+        writeTrophies(Clan, clan_trophies)
+    logging.info('aggregateClanData complete')
+    return clan_results
+
+# The in-memory part of aggregateClanData: set the fields of each of clans from
+# its members (a dict of clan id to Players) and their results, and return a
+# dict of clan id to the ids of its trophies, and one of clan id to its merged
+# AggregateResult.
+def computeClanFields(clans, members, results, stats):
+    clan_trophies = {}
+    clan_results = {}
+    for clan in clans:
+        start = time.perf_counter()
+        clan_plrs = members[clan.id]
+        merged = AggregateResult.merge(results[plr.id] for plr in clan_plrs)
 
         # Basic aggregations can be computed pretty easily from the Players.
-        # post 2021 TODO: test: because of atomic, players have been save()d but
-        # not actually committed to the database yet. Is this getting the right
-        # info?
-        aggrs_dict = clan_plrs.aggregate(Sum('total_games'),
-                                         Sum('wins'),
-                                         Sum('games_over_1000_turns'),
-                                         Sum('games_scummed'),
-                                         Max('longest_streak'))
-        clan.total_games = aggrs_dict['total_games__sum']
-        clan.wins = aggrs_dict['wins__sum']
-        clan.games_over_1000_turns = aggrs_dict['games_over_1000_turns__sum']
-        clan.games_scummed = aggrs_dict['games_scummed__sum']
-        clan.longest_streak = aggrs_dict['longest_streak__max']
-
-        # Unfortunately, we have to do a rather nasty multiple join to get the
-        # total number of distinct achievements earned collectively by all the
-        # clan members. It's still better than getting and combining sets of all
-        # the achievement titles, though.
-        clan.unique_achievements = \
-                clan_plrs.aggregate(Count('game__achievements__id', distinct=True)) \
-                ['game__achievements__id__count']
-
-        # Unique deaths for the clan requires constructing a QuerySet of all
-        # games played by clan members.
-        gamesby_clan = Game.objects.filter(player__clan=clan)
-        # note: there is no winsby_clan because it doesn't seem needed
-        clan.unique_deaths = len(uniqdeaths.compile_unique_deaths(gamesby_clan))
-
-        # Unique ascs are still a one-liner.
-        clan.unique_ascs = len(set(g.rrga() for g in gamesby_clan if g.won))
-
-        # And then back to a (somewhat) simpler model, in which the clan can
-        # just pick fields off its precomputed members.
-        # As with players, skip this if the clan has no games.
-        if clan.wins > 0:
-            # the pattern:
-            # - join on the player's best Game in this stat
-            # - order them by that stat
-            # - pick the first Player from the resulting set
-            # - set the clan leaderboard field to the corresponding Player field
-            # This works nicely because even if all of the players in the clan
-            # have a null instead of a Game for this field, it doesn't crash -
-            # it instead just returns a None, which is correct - the clan has no
-            # qualifying games for that stat.
-            # The [0] reference should be fine - only way that would error is if
-            # the clan had no members.
-            # post 2021 TODO: Should this instead be formatted without the
-            # minning and maxing and instead just be e.g. for minscore
-            # clan.min_score_asc = clan_plrs \
-            #     .order_by('min_score_asc__points') \
-            #     [0].min_score_asc
-            # ... except for the #cond and #ach ones which do need to annotate with a Count
-            clan.min_score_asc = clan_plrs.filter(wins__gt=0) \
-                .annotate(minscore=Min('min_score_asc__points')) \
-                .order_by('minscore') \
-                [0].min_score_asc
-            clan.max_score_asc = clan_plrs.filter(wins__gt=0) \
-                .annotate(maxscore=Max('max_score_asc__points')) \
-                .order_by('-maxscore') \
-                [0].max_score_asc
-            clan.lowest_turncount_asc = clan_plrs.filter(wins__gt=0) \
-                .annotate(minturns=Min('lowest_turncount_asc__turns')) \
-                .order_by('minturns') \
-                [0].lowest_turncount_asc
-            clan.fastest_realtime_asc = clan_plrs.filter(wins__gt=0) \
-                .annotate(mintime=Min('fastest_realtime_asc__wallclock')) \
-                .order_by('mintime') \
-                [0].fastest_realtime_asc
-            clan.first_asc = clan_plrs.filter(wins__gt=0) \
-                .annotate(firsttime=Min('first_asc__endtime')) \
-                .earliest('firsttime').first_asc
-            clan.max_conducts_asc = clan_plrs.filter(wins__gt=0) \
-                .annotate(ncond=Count('max_conducts_asc__conducts')) \
-                .order_by('-ncond') \
-                [0].max_conducts_asc
-
-        if clan.total_games > 0:
-            # Same as the above block but for stats which don't require wins.
-            clan.max_achieves_game = clan_plrs.filter(total_games__gt=0) \
-                .annotate(maxachieve=Count('max_achieves_game__achievements')) \
-                .order_by('-maxachieve') \
-                [0].max_achieves_game
-
-        clan.save()
-        # For clans, we have to remove all trophies before re-awarding them.
-        # This is because a member who provided some of the effort towards a
-        # trophy may have left since the last aggregation.
-        clan.trophies.remove()
-        awardTrophies(clan, gamesby_clan)
-    logging.info('aggregateClanData complete')
+        clan.total_games = sum(plr.total_games for plr in clan_plrs)
+        clan.wins = sum(plr.wins for plr in clan_plrs)
+        clan.games_over_1000_turns = sum(plr.games_over_1000_turns for plr in clan_plrs)
+        clan.games_scummed = sum(plr.games_scummed for plr in clan_plrs)
+        clan.longest_streak = max((plr.longest_streak for plr in clan_plrs), default=0)
+        # the clan got there when the first of its members with that streak did
+        merged.reached['longest_streak'] = min(
+            (results[plr.id].reached['longest_streak'] for plr in clan_plrs
+             if plr.longest_streak == clan.longest_streak
+             and results[plr.id].reached['longest_streak'] is not None), default=None)
+
+        # The distinct things done by the clan collectively are the unions of
+        # what its members did.
+        clan.unique_achievements = len(merged.achievements)
+        clan.unique_deaths = len(merged.deaths)
+        clan.unique_ascs = len(merged.ascs)
+
+        # And the clan's best game in each statistic is the best of its
+        # members' best games.
+        for field, _, _ in BEST_GAMES:
+            setattr(clan, field + '_id', None if merged.best[field] is None else merged.best[field].id)
+
+        # The clan's trophies are worked out from scratch every time, and
+        # any it no longer has are removed. This is because a member who
+        # provided some of the effort towards a trophy may have left since the
+        # last aggregation.
+        clan_trophies[clan.id] = TROPHY_EVALUATOR.evaluate(clan, merged.trophy_bits)
+        clan_results[clan.id] = merged
+        stats.clan_times[clan.name] = time.perf_counter() - start
+    return clan_trophies, clan_results
+
+# Rewrite the UniqueDeath rows of the given Players and Clans (default: all of
+# them, from scratch). Their Games are streamed once in endtime order, so the
+# first Game seen with a given Death is the player's (or clan's) first one.
+# Afterwards, the first flags are worked out again for every Death whose rows
+# changed or which has lost its first row, taking the rows of everyone else
+# into account.
+def writeUniqueDeaths(players=None, clans=None):
+    full = players is None and clans is None
+    plr_ids = None if full else set(plr.id for plr in players)
+    clan_ids = None if full else set(clan.id for clan in clans)
+
+    game_qs = Game.objects.exclude(normalized_death=None)
+    old_qs = UniqueDeath.objects.all()
+    if not full:
+        game_qs = game_qs.filter(Q(player__in=plr_ids) | Q(player__clan__in=clan_ids))
+        old_qs = old_qs.filter(Q(player__in=plr_ids) | Q(clan__in=clan_ids))
+
+    rows = []
+    seen = set()
+    for death_id, plr_id, clan_id, game_id, endtime in game_qs.order_by('endtime', 'id') \
+            .values_list('normalized_death_id', 'player_id', 'player__clan_id', 'id', 'endtime') \
+            .iterator(chunk_size=BULK_BATCH_SIZE):
+        if (full or plr_id in plr_ids) and (death_id, 'player', plr_id) not in seen:
+            seen.add((death_id, 'player', plr_id))
+            rows.append(UniqueDeath(death_id=death_id, player_id=plr_id,
+                                    game_id=game_id, endtime=endtime))
+        if clan_id is not None and (full or clan_id in clan_ids) \
+                and (death_id, 'clan', clan_id) not in seen:
+            seen.add((death_id, 'clan', clan_id))
+            rows.append(UniqueDeath(death_id=death_id, clan_id=clan_id,
+                                    game_id=game_id, endtime=endtime))
+
+    # The rows of everyone else for the Deaths being rewritten, which compete
+    # with the new ones for being first. Deaths left without a first player or
+    # first clan are decided again too: disbanding a clan deletes its rows,
+    # first ones included, without leaving anyone dirty.
+    kept = []
+    if not full:
+        deaths = set(row.death_id for row in rows)
+        deaths.update(old_qs.values_list('death_id', flat=True))
+        for is_player in (True, False):
+            firsts_qs = UniqueDeath.objects.filter(clan__isnull=is_player, first=True)
+            deaths.update(UniqueDeath.objects.filter(clan__isnull=is_player)
+                          .exclude(death__in=firsts_qs.values('death_id'))
+                          .values_list('death_id', flat=True).distinct())
+        kept = list(UniqueDeath.objects.filter(death__in=deaths).exclude(id__in=old_qs)
+                    .values_list('id', 'death_id', 'clan_id', 'endtime', 'game_id', 'first'))
+
+    # The first player and first clan for each Death, as (endtime, game id,
+    # new row or id of a kept row).
+    firsts = {}
+    candidates = [ ((row.death_id, row.clan_id is None), (row.endtime, row.game_id, row))
+                   for row in rows ] \
+        + [ ((death_id, clan_id is None), (endtime, game_id, row_id))
+            for row_id, death_id, clan_id, endtime, game_id, _ in kept ]
+    for key, candidate in candidates:
+        if key not in firsts or candidate[:2] < firsts[key][:2]:
+            firsts[key] = candidate
+    first_ids = set()
+    for _, _, row in firsts.values():
+        if isinstance(row, UniqueDeath):
+            row.first = True
+        else:
+            first_ids.add(row)
+
+    old_qs.delete()
+    UniqueDeath.objects.bulk_create(rows, batch_size=BULK_BATCH_SIZE)
+    # only the kept rows whose flag changed are written
+    for flag in (False, True):
+        UniqueDeath.objects.filter(id__in=[ row_id for row_id, *_, first in kept
+                                            if first != flag and (row_id in first_ids) == flag ]) \
+            .update(first=flag)
+    logging.info('writeUniqueDeaths complete')
+
+# Rewrite the LeaderboardEntry rows of the Players and Clans in results and
+# clan_results (this run's AggregateResults, by id), then rank everyone on
+# every board again. With full, those are all of them and every row is
+# rewritten; otherwise the rows of everyone else are kept, and only their
+# ranks and (for players, whose clan can change without them being
+# recomputed) clan names are brought up to date.
+def writeLeaderboards(results, clan_results, full=False):
+    new_rows = []
+    for model, is_clan, entity_results in ((Player, False, results), (Clan, True, clan_results)):
+        fields = ['id', 'name', 'total_games', 'wins']
+        fields += [ L['stat'] for L in leaderboards.LEADERBOARDS if 'stat' in L ]
+        for L in leaderboards.LEADERBOARDS:
+            if 'game' in L:
+                fields += [ L['game'] + '__' + col for col in (L['column'], 'starttime', 'endtime',
+                                                               'player__name', 'source__dumplog_fmt') ]
+        qs = model.objects.all() if full else model.objects.filter(id__in=entity_results.keys())
+        for row in qs.values(*fields).iterator(chunk_size=BULK_BATCH_SIZE):
+            for L in leaderboards.LEADERBOARDS:
+                if row['wins' if L['wins_only'] else 'total_games'] == 0:
+                    continue
+                dumplog = None
+                if 'game' in L:
+                    stat = row[L['game'] + '__' + L['column']]
+                    reached = row[L['game'] + '__endtime']
+                    if stat is not None:
+                        dumplog = dumplog_utils.format_dumplog(row[L['game'] + '__source__dumplog_fmt'],
+                                                               row[L['game'] + '__player__name'],
+                                                               row[L['game'] + '__starttime'])
+                else:
+                    stat = row[L['stat']]
+                    reached = entity_results[row['id']].reached[L['stat']]
+                if stat is None:
+                    # could indicate a field was not correctly populated, such
+                    # as a Player who has wins > 0 but first_asc is None
+                    logger.error('leaderboard %s: no stat for %s %s',
+                                 L['id'], 'clan' if is_clan else 'player', row['name'])
+                    continue
+                new_rows.append(LeaderboardEntry(
+                    board=L['id'], is_clan=is_clan, rank=0,
+                    player_id=None if is_clan else row['id'],
+                    clan_id=row['id'] if is_clan else None,
+                    name=row['name'],
+                    stat=leaderboards.format_stat(stat), value=leaderboards.sort_value(stat),
+                    reached=reached, dumplog=dumplog))
+
+    if full:
+        LeaderboardEntry.objects.all().delete()
+        kept = []
+    else:
+        LeaderboardEntry.objects.filter(Q(player__in=results.keys())
+                                        | Q(clan__in=clan_results.keys())).delete()
+        kept = list(LeaderboardEntry.objects.only('board', 'is_clan', 'rank', 'name', 'value',
+                                                  'reached'))
+
+    boards = defaultdict(list)
+    for entry in kept + new_rows:
+        boards[entry.board, entry.is_clan].append(entry)
+    changed = []
+    for L in leaderboards.LEADERBOARDS:
+        for is_clan in (False, True):
+            ranked = sorted(boards[L['id'], is_clan], key=leaderboards.rank_key(L['descending']))
+            for rank, entry in enumerate(ranked, 1):
+                if entry.id is not None and entry.rank != rank:
+                    changed.append(entry)
+                entry.rank = rank
+    LeaderboardEntry.objects.bulk_update(changed, ['rank'], batch_size=BULK_BATCH_SIZE)
+    LeaderboardEntry.objects.bulk_create(new_rows, batch_size=BULK_BATCH_SIZE)
+    logging.info('writeLeaderboards complete')
+
+# Work out which Players and Clans an incremental run has to recompute: the
+# ones flagged dirty (by ingest or clan membership changes), plus the players
+# of any Game past the watermark and their clans.
+def dirtyPlayersAndClans(watermark):
+    plr_ids = set(Player.objects.filter(dirty=True).values_list('id', flat=True))
+    plr_ids.update(Game.objects.filter(id__gt=watermark.last_game_id)
+                   .values_list('player_id', flat=True))
+    clan_ids = set(Clan.objects.filter(dirty=True).values_list('id', flat=True))
+    clan_ids.update(Player.objects.filter(id__in=plr_ids, clan__isnull=False)
+                    .values_list('clan_id', flat=True))
+    return plr_ids, clan_ids
 
 class Command(BaseCommand):
     help = 'Compute aggregate data from the set of all games'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Only recompute players with new games since the last run, and their clans.',
+        )
+        parser.add_argument(
+            '--numpy',
+            action='store_true',
+            help='Compute counts and best games with the NumPy columnar backend.',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of processes to compute player data in. Each one opens its '
+                 'own connection, so this needs a database they can all reach '
+                 '(not in-memory SQLite).',
+        )
+        parser.add_argument(
+            '--profile',
+            metavar='FILE',
+            help='Run under cProfile and write the stats to FILE (see the pstats module). '
+                 'With --workers, only this process is profiled, not the workers.',
+        )
+
     # post 2021 TODO: move most of this file's logic to tnnt/aggregate.py so that it can
     # be called on clan-membership-change events, subject to design discussion
     # on if that is a sound idea
     def handle(self, *args, **options):
+        if options['numpy'] and not columnar.available():
+            raise RuntimeError('--numpy needs NumPy, which is not installed')
+        stats = AggregationStats()
+        sql = SQLTimer()
+        started = timezone.now()
+        start = time.perf_counter()
+        profiler = cProfile.Profile() if options['profile'] else None
+        if profiler is not None:
+            profiler.enable()
+        try:
+            with connection.execute_wrapper(sql):
+                players, clans = self.aggregate(options, stats)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(options['profile'])
+        seconds = time.perf_counter() - start
+
+        report = stats.report()
+        AggregationRun.objects.create(started=started, incremental=options['incremental'],
+                                      workers=options['workers'], players=len(players),
+                                      clans=len(clans), seconds=seconds, queries=sql.queries,
+                                      sql_seconds=sql.seconds, report=report)
+        logger.info('aggregated %d players and %d clans%s in %.3fs, %d queries (%.3fs in SQL)',
+                    len(players), len(clans), ' (incremental)' if options['incremental'] else '',
+                    seconds, sql.queries, sql.seconds)
+        for phase in report['phases']:
+            logger.info('aggregate phase %-28s %8.3fs %6d queries %8.3fs in SQL',
+                        phase['name'], phase['seconds'], phase['queries'], phase['sql_seconds'])
+        for name, seconds in report['timers'].items():
+            logger.info('aggregate timer %-28s %8.3fs', name, seconds)
+        for what in ('players', 'clans'):
+            logger.info('aggregate slowest %s: %s', what,
+                        ', '.join('%s %.4fs' % t for t in report['slowest_' + what]))
+        if options['profile']:
+            logger.info('aggregate profile written to %s', options['profile'])
+
+    # The aggregation itself. Returns the Players and Clans recomputed.
+    def aggregate(self, options, stats):
         # This will end up doing a bunch of writes. Force them to happen all at
         # once with atomic().
         # If this is not done, someone could load a page when e.g. Player writes
@@ -350,5 +904,54 @@ class Command(BaseCommand):
         # with the new best realtime game doesn't have their clan at the top of
         # the leaderboard. Or any of several similar problems.
         with transaction.atomic():
-            aggregatePlayerData()
-            aggregateClanData()
+            with stats.phase('find dirty'):
+                AggregationWatermark.objects.get_or_create(pk=1)
+                watermark = AggregationWatermark.objects.select_for_update().get(pk=1)
+                # Taken before reading any Games, so a Game that comes in while
+                # this runs is past the new watermark and gets picked up next time.
+                last_game_id = Game.objects.aggregate(Max('id'))['id__max'] or 0
+                # The rows being recomputed are locked, so that ingest flagging one
+                # of them dirty again waits until this commits rather than having
+                # the flag cleared below.
+                if options['incremental']:
+                    plr_ids, clan_ids = dirtyPlayersAndClans(watermark)
+                    players = Player.objects.select_for_update().filter(id__in=plr_ids)
+                    clans = Clan.objects.select_for_update().filter(id__in=clan_ids)
+                else:
+                    # The full run recomputes everyone regardless of dirty flags,
+                    # so it doubles as a consistency check on the incremental runs.
+                    players = Player.objects.select_for_update()
+                    clans = Clan.objects.select_for_update()
+                players = list(players)
+                clans = list(clans)
+            results = aggregatePlayerData(players, all_players=not options['incremental'],
+                                          use_numpy=options['numpy'],
+                                          workers=options['workers'], stats=stats)
+            clan_results = aggregateClanData(clans, results, stats=stats)
+            with stats.phase('unique deaths'):
+                if options['incremental']:
+                    writeUniqueDeaths(players, clans)
+                else:
+                    writeUniqueDeaths()
+            with stats.phase('leaderboards'):
+                writeLeaderboards(results, clan_results, full=not options['incremental'])
+            with stats.phase('site stats'):
+                SiteStats.objects.recount()
+                if not options['incremental']:
+                    RecentGame.objects.rebuild()
+
+            with stats.phase('clear dirty'):
+                if options['incremental']:
+                    Player.objects.filter(id__in=plr_ids).update(dirty=False)
+                    Clan.objects.filter(id__in=clan_ids).update(dirty=False)
+                else:
+                    Player.objects.filter(dirty=True).update(dirty=False)
+                    Clan.objects.filter(dirty=True).update(dirty=False)
+                watermark.last_game_id = max(watermark.last_game_id, last_game_id)
+                if options['incremental']:
+                    watermark.last_incremental = timezone.now()
+                else:
+                    watermark.last_full = timezone.now()
+                watermark.save()
+                DataGeneration.objects.bump()
+        return players, clans
@@ -0,0 +1,132 @@
+# Bulk (re-)import of whole xlogfiles, e.g. after `wipe_db --games` or when a
+# new server is added. Produces the same Games as pollxlogs, but parses the
+# file in parallel worker processes.
+from django.core.management.base import BaseCommand
+from django.db import transaction, connections
+from scoreboard import bitfields
+from scoreboard.models import Source, Game
+from scoreboard.parsers import XlogMmapParser, bisect_endtime
+from tnnt.settings import XLOG_DIR, TOURNAMENT_START
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from ._private import init_parser_process
+import logging
+import os
+import time
+
+logger = logging.getLogger() # root logger
+
+# Approximate size of the pieces the xlog is split into for the workers.
+BACKFILL_SHARD_BYTES = 4 * 1024 * 1024
+# Number of Games handed to insert_pending at once while loading a shard.
+BACKFILL_LOAD_ROWS = 5000
+
+
+# Split the byte range [start, end) of the file into (start, end) ranges of
+# roughly shard_bytes each, with every boundary at the start of a line.
+# start and end must themselves be at the start of a line.
+def shard_boundaries(xlog_path, start, end, shard_bytes):
+    bounds = [ start ]
+    with xlog_path.open('rb') as xlog_file:
+        pos = start + shard_bytes
+        while pos < end:
+            # step back a byte and finish that line, so that a boundary which
+            # already falls at the start of a line stays put
+            xlog_file.seek(pos - 1)
+            xlog_file.readline()
+            pos = xlog_file.tell()
+            if pos >= end:
+                break
+            bounds.append(pos)
+            pos += shard_bytes
+    bounds.append(end)
+    return [ (s, e) for s, e in zip(bounds, bounds[1:]) if s < e ]
+
+
+# Worker process: parse the given xlog fields of the lines in [start, end) and
+# run them through game_kwargs. Returns the (xlog_dict, kwargs) pairs for lines that become
+# Games, and the offset just past the last complete line read. No database
+# access happens here: the bitfield decoder comes from init_parser_process, and
+# the source is filled in by the caller.
+def parse_shard(xlog_path, start, end, fields):
+    pending = []
+    pos = start
+    for xlog_dict, pos in XlogMmapParser(fields).iterparse_path(xlog_path, start, end):
+        kwargs = Game.objects.game_kwargs(None, xlog_dict)
+        if kwargs is not None:
+            pending.append((xlog_dict, kwargs))
+    return pending, pos
+
+
+# Import everything in src's local xlog past its file_pos. Shards are loaded in
+# file order, each in its own transaction that also advances file_pos, so an
+# interrupted backfill can simply be run again.
+def backfill_source(src, workers, shard_bytes):
+    xlog_path = Path(XLOG_DIR) / src.local_file
+    # lines that ended before the tournament aren't worth handing out; those
+    # after it are, as for pollxlogs, in case one in the window follows them
+    end = xlog_path.stat().st_size
+    with xlog_path.open('rb') as xlog_file:
+        start = bisect_endtime(xlog_file, int(TOURNAMENT_START.timestamp()),
+                               src.file_pos, end)
+    if start != src.file_pos:
+        src.file_pos = start
+        src.save()
+    shards = shard_boundaries(xlog_path, start, end, shard_bytes)
+    fields = Game.objects.xlog_fields()
+    decoder = bitfields.get_decoder()
+    ngames = 0
+    # don't let forked workers inherit an open database connection
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_parser_process,
+                             initargs=(decoder,)) as pool:
+        results = pool.map(parse_shard,
+                           [ str(xlog_path) ] * len(shards),
+                           [ s for s, _ in shards ],
+                           [ e for _, e in shards ],
+                           [ fields ] * len(shards))
+        for pending, end_pos in results:
+            for _, kwargs in pending:
+                kwargs['source'] = src
+            with transaction.atomic():
+                for i in range(0, len(pending), BACKFILL_LOAD_ROWS):
+                    ngames += len(Game.objects.insert_pending(src, pending[i:i + BACKFILL_LOAD_ROWS]))
+                src.file_pos = end_pos
+                src.save()
+    return ngames
+
+
+class Command(BaseCommand):
+    help = 'Import whole xlogfiles in bulk, parsing them in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'servers',
+            nargs='*',
+            help='Server names of the Sources to backfill (default: all of them).',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count(),
+            help='Number of parser processes.',
+        )
+        parser.add_argument(
+            '--shard-bytes',
+            type=int,
+            default=BACKFILL_SHARD_BYTES,
+            help='Approximate size of each piece of the xlog handed to a worker.',
+        )
+
+    def handle(self, *args, **options):
+        sources = Source.objects.order_by('id')
+        if options['servers']:
+            sources = sources.filter(server__in=options['servers'])
+        if len(sources) == 0:
+            raise RuntimeError('There are no matching sources in the database to backfill!')
+        for src in sources:
+            start = time.monotonic()
+            ngames = backfill_source(src, options['workers'], options['shard_bytes'])
+            logger.info('backfill of %s imported %d games in %.2fs',
+                        src.server, ngames, time.monotonic() - start)
+            print('%s: imported %d games, file_pos now %d' % (src.server, ngames, src.file_pos))
@@ -0,0 +1,206 @@
+# End-to-end benchmark: generate a synthetic tournament at a few sizes, then
+# time ingest, aggregation and the main pages against it, counting queries.
+# Runs against a throwaway test database, so it never touches the real data.
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from scoreboard import bitfields
+from scoreboard.models import Conduct, Achievement, Source, Player, Clan, Game
+from scoreboard.parsers import XlogParser, XlogMmapParser
+from tnnt import pagecache, settings
+from ._private import XlogGenerator, assign_clans
+from .wipe_db import wipe_non_fixtures
+from contextlib import contextmanager
+import json
+import os
+import tempfile
+import time
+
+# (players, games, clans) at 1x; larger scales multiply all three.
+BENCHMARK_BASE_SCALE = (100, 2000, 10)
+
+# Pages timed after aggregation, with and without the page cache. {player}
+# and {clan} are filled in with the player with the most games and the clan
+# with the most members.
+BENCHMARK_PAGES = [
+    '/',
+    '/leaderboards',
+    '/trophies',
+    '/achievements',
+    '/uniquedeaths',
+    '/clans',
+    '/players',
+    '/player/{player}',
+    '/clan/{clan}',
+]
+
+
+class QueryCounter:
+    # execute_wrapper that counts the queries run through it
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def timed(results, scale, phase):
+    # time the body and count its queries, appending a result row
+    counter = QueryCounter()
+    start = time.perf_counter()
+    with connection.execute_wrapper(counter):
+        yield
+    results.append({ 'scale': scale, 'phase': phase,
+                     'seconds': time.perf_counter() - start,
+                     'queries': counter.count })
+
+
+@transaction.atomic
+def create_clans(nclans, seed):
+    players = Player.objects.order_by('name')
+    for i, members in enumerate(assign_clans(players, nclans,
+                                             settings.MAX_CLAN_PLAYERS, seed)):
+        clan = Clan.objects.create(name='clan%04d' % i)
+        for player in members:
+            player.clan = clan
+            player.clan_admin = player is members[0]
+            player.save()
+
+
+# Time parsing the xlog at xlog_path, without importing it: with the streaming
+# text parser, which converts every field, and with the mmap parser asked for
+# only the fields ingest needs, as pollxlogs and backfill use it.
+def time_parsers(xlog_path, label, results):
+    with timed(results, label, 'parse XlogParser.iterparse'):
+        with open(xlog_path, 'rb') as xlog_file:
+            for _ in XlogParser().iterparse(xlog_file):
+                pass
+    fields = Game.objects.xlog_fields()
+    with timed(results, label, 'parse XlogMmapParser'):
+        for _ in XlogMmapParser(fields).iterparse_path(xlog_path):
+            pass
+
+
+def run_scale(scale, seed, workdir, results, use_numpy=False, workers=(), parsers=False):
+    nplayers, ngames, nclans = ( n * scale for n in BENCHMARK_BASE_SCALE )
+    label = '%dx' % scale
+    wipe_non_fixtures()
+    Source.objects.all().delete()
+
+    start = time.perf_counter()
+    gen = XlogGenerator(Conduct.objects.values_list('xlogfield', 'bit'),
+                        Achievement.objects.values_list('xlogfield', 'bit'),
+                        settings.TOURNAMENT_START, settings.TOURNAMENT_END,
+                        seed=seed)
+    xlog_path = os.path.join(workdir, 'bench-%s.xlog' % label)
+    with open(xlog_path, 'w') as xlog_file:
+        for line in gen.generate(nplayers, ngames):
+            xlog_file.write(line + '\n')
+    results.append({ 'scale': label, 'phase': 'generate',
+                     'seconds': time.perf_counter() - start, 'queries': 0 })
+    if parsers:
+        time_parsers(xlog_path, label, results)
+
+    # an absolute local_file overrides XLOG_DIR, and no location means
+    # pollxlogs only reads what is already on disk
+    Source.objects.create(server='bench', local_file=xlog_path, location=None,
+                          last_check=timezone.now(), dumplog_fmt='')
+
+    with timed(results, label, 'pollxlogs'):
+        call_command('pollxlogs')
+    create_clans(nclans, seed)
+    with timed(results, label, 'aggregate'):
+        call_command('aggregate')
+    if use_numpy:
+        with timed(results, label, 'aggregate --numpy'):
+            call_command('aggregate', numpy=True)
+    for nworkers in workers:
+        with timed(results, label, 'aggregate --workers=%d' % nworkers):
+            call_command('aggregate', workers=nworkers)
+
+    player = max(Player.objects.all(), key=lambda p: p.total_games)
+    clan = max(Clan.objects.all(), key=lambda c: c.player_set.count())
+    client = Client()
+    for page in BENCHMARK_PAGES:
+        url = page.format(player=player.name, clan=clan.name)
+        # the first request pays for template compilation and the like
+        client.get(url)
+        # then the page is timed being worked out, and served from the cache
+        caches[pagecache.PAGE_CACHE].clear()
+        with timed(results, label, 'GET ' + page):
+            response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError('%s returned %d' % (url, response.status_code))
+        with timed(results, label, 'GET %s cached' % page):
+            client.get(url)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark ingest, aggregation and page rendering on synthetic tournaments'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scales',
+            default='1,10,100',
+            help='Comma-separated multiples of the 1x size (%d players, %d games, %d clans).'
+                 % BENCHMARK_BASE_SCALE,
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+        parser.add_argument('--json', metavar='FILE', help='Also write the results to FILE as JSON.')
+        parser.add_argument(
+            '--numpy',
+            action='store_true',
+            help='Also time aggregation with the NumPy columnar backend.',
+        )
+        parser.add_argument(
+            '--workers',
+            default='',
+            help='Comma-separated worker counts to also time aggregation with, e.g. 1,2,4,8. '
+                 'The test database must be one that other processes can open '
+                 '(not in-memory SQLite).',
+        )
+        parser.add_argument(
+            '--parsers',
+            action='store_true',
+            help='Also time parsing the generated xlog with XlogParser.iterparse and '
+                 'XlogMmapParser, without importing it.',
+        )
+        parser.add_argument(
+            '--keepdb',
+            action='store_true',
+            help='Reuse the test database if it already exists, and keep it afterwards.',
+        )
+
+    def handle(self, *args, **options):
+        scales = [ int(s) for s in options['scales'].split(',') ]
+        workers = [ int(w) for w in options['workers'].split(',') if w ]
+        results = []
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           keepdb=options['keepdb'])
+        try:
+            call_command('loaddata', 'achievements', 'conducts', 'trophies', verbosity=0)
+            bitfields.get_decoder(reload=True)
+            with tempfile.TemporaryDirectory() as workdir:
+                for scale in scales:
+                    run_scale(scale, options['seed'], workdir, results, options['numpy'], workers,
+                              options['parsers'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0,
+                                                keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        print('%-6s %-28s %10s %8s' % ('scale', 'phase', 'seconds', 'queries'))
+        for row in results:
+            print('%-6s %-28s %10.3f %8d' % (row['scale'], row['phase'],
+                                             row['seconds'], row['queries']))
+        if options['json']:
+            with open(options['json'], 'w') as json_file:
+                json.dump(results, json_file, indent=2)
@@ -0,0 +1,26 @@
+# Write a synthetic tournament xlogfile, for load testing and benchmarking.
+from django.core.management.base import BaseCommand
+from scoreboard.models import Conduct, Achievement
+from tnnt import settings
+from ._private import XlogGenerator
+
+
+class Command(BaseCommand):
+    help = 'Generate a synthetic tournament xlogfile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('outfile', help='Path of the xlogfile to write.')
+        parser.add_argument('--players', type=int, default=1000, help='Number of players.')
+        parser.add_argument('--games', type=int, default=20000, help='Approximate number of games.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+
+    def handle(self, *args, **options):
+        gen = XlogGenerator(Conduct.objects.values_list('xlogfield', 'bit'),
+                            Achievement.objects.values_list('xlogfield', 'bit'),
+                            settings.TOURNAMENT_START, settings.TOURNAMENT_END,
+                            seed=options['seed'])
+        lines = gen.generate(options['players'], options['games'])
+        with open(options['outfile'], 'w') as outfile:
+            for line in lines:
+                outfile.write(line + '\n')
+        print('wrote %d games to %s' % (len(lines), options['outfile']))
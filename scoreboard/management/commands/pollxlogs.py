@@ -1,45 +1,203 @@
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
 from scoreboard.models import Source, Game
-from django.db import transaction
-from scoreboard.parsers import XlogParser
-from tnnt.settings import XLOG_DIR
+from django.db import transaction, close_old_connections
+from scoreboard.parsers import XlogMmapParser, bisect_endtime
+from tnnt.settings import XLOG_DIR, TOURNAMENT_START
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import logging
+import os
+import time
 import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger() # root logger
+
+
+# Number of xlog lines imported per transaction. Source.file_pos is advanced
+# after each chunk, so an interrupted import resumes from the last committed
+# chunk rather than from the start of the file.
+IMPORT_CHUNK_LINES = 1000
 
 
 @transaction.atomic
+def import_chunk(src, xlog_entries, end_pos):
+    # lines that don't produce a game (explore/wizmode game, outside
+    # tournament time, etc) are skipped by from_xlog_batch
+    games = Game.objects.from_xlog_batch(src, xlog_entries)
+    src.file_pos = end_pos
+    src.save()
+    return len(games)
+
+
+# Import everything in the local xlog past src.file_pos, and return the number
+# of Games created.
+# Since xlog lines are in endtime order, lines which ended before the
+# tournament are skipped over with a binary search instead of being read.
+# Reading doesn't stop at the first line which ended after the tournament,
+# though: lines can be a little out of order (clock skew, or a line appended
+# late), so one in the window could still follow it. Lines that ended too late
+# are dropped by game_kwargs like any other that doesn't make a Game, and
+# file_pos still gets to the end of the file.
 def import_records(src):
     xlog_path = Path(XLOG_DIR) / src.local_file
-    with xlog_path.open("r") as xlog_file:
-        xlog_file.seek(src.file_pos)
-        for xlog_entry in XlogParser().parse(xlog_file):
-            game = Game.objects.from_xlog(src, xlog_entry)
-            # check None because a game may not have been produced
-            # (explore/wizmode game, outside tournament time, etc)
-            if game is not None:
-                game.save()
-        src.file_pos = xlog_file.tell()
-        src.save()
-
-
-def sync_local_file(url, local_file):
+    with xlog_path.open("rb") as xlog_file:
+        start = bisect_endtime(xlog_file, int(TOURNAMENT_START.timestamp()),
+                               src.file_pos, xlog_path.stat().st_size)
+        if start != src.file_pos:
+            src.file_pos = start
+            src.save()
+        parser = XlogMmapParser(Game.objects.xlog_fields())
+        entries = parser.iterparse_path(xlog_path, start)
+        ngames = 0
+        while True:
+            chunk = list(itertools.islice(entries, IMPORT_CHUNK_LINES))
+            if len(chunk) == 0:
+                break
+            ngames += import_chunk(src, [ xlog_entry for xlog_entry, _ in chunk ], chunk[-1][1])
+    return ngames
+
+
+# Seconds to wait on a server to accept a connection or send more data
+# before giving up on it for this poll.
+FETCH_TIMEOUT = 30
+# Size of the pieces the response is written to the local xlog in.
+FETCH_CHUNK_BYTES = 64 * 1024
+
+
+# Append whatever new data the server has for this xlog to the local copy,
+# and return the number of bytes written.
+def sync_local_file(url, local_file, session=requests, timeout=FETCH_TIMEOUT):
     xlog_path = Path(XLOG_DIR) / local_file
+    written = 0
     with xlog_path.open("ab") as xlog_file:
-        r = requests.get(url, headers={"Range": f"bytes={xlog_file.tell()}-"})
-        # 206 means they are honouring our Range request c:
-        if r.status_code != 206:
-            return
-        for chunk in r.iter_content(chunk_size=128):
-            xlog_file.write(chunk)
+        with session.get(url, headers={"Range": f"bytes={xlog_file.tell()}-"},
+                         stream=True, timeout=timeout) as r:
+            # 206 means they are honouring our Range request c:
+            if r.status_code != 206:
+                return 0
+            for chunk in r.iter_content(chunk_size=FETCH_CHUNK_BYTES):
+                xlog_file.write(chunk)
+                written += len(chunk)
+    return written
+
+
+# Download new data for every source at once, so that one slow server doesn't
+# hold up the others. A source that fails is logged and skipped; whatever it
+# already has locally still gets imported. Returns a dict of server name =>
+# (seconds taken, bytes written).
+def fetch_sources(sources):
+    def fetch(src, session):
+        start = time.monotonic()
+        nbytes = 0
+        try:
+            nbytes = sync_local_file(src.location, src.local_file, session)
+        except requests.RequestException as e:
+            logger.error('fetching xlog for %s from %s failed: %s',
+                         src.server, src.location, e)
+        return time.monotonic() - start, nbytes
+
+    remote = [ src for src in sources if src.location ]
+    if len(remote) == 0:
+        return {}
+    with requests.Session() as session, \
+         ThreadPoolExecutor(max_workers=len(remote)) as pool:
+        # keep a connection pool for each server, so repeated polls within
+        # the session reuse their connections
+        adapter = HTTPAdapter(pool_connections=len(remote))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        futures = { src.server: pool.submit(fetch, src, session) for src in remote }
+        stats = { server: fut.result() for server, fut in futures.items() }
+    for server, (secs, nbytes) in stats.items():
+        logger.info('fetched %d bytes for %s in %.2fs', nbytes, server, secs)
+    return stats
+
+
+# Daemon mode defaults: how often (in seconds) local xlogs are checked for
+# growth and each server is polled, and how far polling of a server that keeps
+# having nothing new backs off.
+DAEMON_INTERVAL = 10
+DAEMON_MAX_INTERVAL = 300
+
+
+def local_file_size(src):
+    try:
+        return os.stat(Path(XLOG_DIR) / src.local_file).st_size
+    except FileNotFoundError:
+        return 0
+
+
+# Stay resident and keep polling. Every interval seconds, fetch from the
+# servers that are due, then import any local xlog that has grown past its
+# file_pos. A server that returned no new data is polled half as often next
+# time, up to max_interval, and goes back to every interval as soon as it has
+# data again. Aggregation only runs when at least one new Game came in, and
+# only for the players and clans that need it.
+def run_daemon(interval, max_interval):
+    wait = {}
+    due = {}
+    while True:
+        try:
+            close_old_connections()
+            # re-read every time, in case of new sources or a file_pos reset
+            sources = list(Source.objects.order_by('id'))
+            now = time.monotonic()
+            polled = [ src for src in sources if due.get(src.server, 0) <= now ]
+            fetched = fetch_sources(polled)
+            for src in polled:
+                if fetched.get(src.server, (0, 0))[1] > 0:
+                    wait[src.server] = interval
+                else:
+                    wait[src.server] = min(wait.get(src.server, interval) * 2, max_interval)
+                due[src.server] = now + wait[src.server]
+
+            new_games = 0
+            for src in sources:
+                if local_file_size(src) > src.file_pos:
+                    new_games += import_records(src)
+            if new_games > 0:
+                logger.info('pollxlogs daemon imported %d new games, aggregating', new_games)
+                call_command('aggregate', incremental=True)
+        except Exception:
+            # keep the daemon alive; the next pass will retry from file_pos
+            logger.exception('pollxlogs daemon pass failed')
+        time.sleep(interval)
 
 
 class Command(BaseCommand):
     help = "Poll Sources (xlogfiles) for new game data"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--daemon',
+            action='store_true',
+            help='Keep running, polling sources and aggregating whenever new games come in.',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=DAEMON_INTERVAL,
+            help='With --daemon, seconds between checks for new data.',
+        )
+        parser.add_argument(
+            '--max-interval',
+            type=float,
+            default=DAEMON_MAX_INTERVAL,
+            help='With --daemon, longest time in seconds between polls of an idle server.',
+        )
+
     def handle(self, *args, **options):
-        sources = Source.objects.all()
+        sources = Source.objects.order_by('id')
         if len(sources) == 0:
             raise RuntimeError('There are no sources in the database to poll!')
+        if options['daemon']:
+            run_daemon(options['interval'], options['max_interval'])
+            return
+        # Downloads happen concurrently, but importing is still done one
+        # source at a time and in a fixed order.
+        fetch_sources(sources)
         for src in sources:
-            sync_local_file(src.location, src.local_file)
             import_records(src)
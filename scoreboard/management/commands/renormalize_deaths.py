@@ -0,0 +1,46 @@
+# Recompute Game.normalized_death after UNIQUE_DEATH_REJECTIONS or
+# UNIQUE_DEATH_NORMALIZATIONS have changed, or for Games ingested before the
+# column existed. Only the distinct raw death strings are normalized, and each
+# one that changed costs a single UPDATE, however many Games have it.
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from scoreboard.models import Game, Death, Player, Clan
+from tnnt import uniqdeaths
+import logging
+
+logger = logging.getLogger() # root logger
+
+
+class Command(BaseCommand):
+    help = 'Renormalize the unique deaths of all Games with the current settings'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            # a raw death string can only map to several Deaths if an earlier
+            # run was interrupted, which just means it gets updated
+            current = {}
+            for death, death_id in Game.objects.order_by() \
+                    .values_list('death', 'normalized_death_id').distinct():
+                current.setdefault(death, set()).add(death_id)
+
+            normalized = { death: uniqdeaths.normalized_or_none(death) for death in current }
+            death_ids = Death.objects.intern(name for name in normalized.values() if name is not None)
+
+            changed = []
+            for death, old_ids in current.items():
+                new_id = death_ids.get(normalized[death])
+                if old_ids != { new_id }:
+                    changed.append(death)
+                    Game.objects.filter(death=death).update(normalized_death_id=new_id)
+
+            # Deaths that nothing normalizes to any more
+            orphans, _ = Death.objects.exclude(id__in=set(death_ids.values())).delete()
+
+            # everyone who has one of the changed deaths has to be aggregated again
+            nplayers = Player.objects.filter(game__death__in=changed, dirty=False).update(dirty=True)
+            Clan.objects.filter(player__game__death__in=changed, dirty=False).update(dirty=True)
+
+        logger.info('renormalize_deaths: %d of %d distinct deaths changed, %d Deaths removed, %d players marked dirty',
+                    len(changed), len(current), orphans, nplayers)
+        print('%d of %d distinct deaths changed, %d Deaths removed, %d players to re-aggregate'
+              % (len(changed), len(current), orphans, nplayers))
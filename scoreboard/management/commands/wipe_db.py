@@ -22,6 +22,7 @@ def wipe_leaderboard_fields(entity):
     entity.min_score_asc = None
     entity.max_score_asc = None
     entity.first_asc = None
+    entity.dirty = True
     entity.save()
 
 
@@ -35,14 +36,29 @@ def reset_source_file_positions():
 @transaction.atomic
 def clear_player_and_clan_fields():
     for player in Player.objects.all():
+        player.streak_state = None
         wipe_leaderboard_fields(player)
     for clan in Clan.objects.all():
         wipe_leaderboard_fields(clan)
 
 
+# Delete what ingest and aggregation work out from the Games, which has to go
+# along with them, and make the cached pages stale.
+@transaction.atomic
+def wipe_derived():
+    Death.objects.all().delete()
+    AggregationWatermark.objects.all().delete()
+    LeaderboardEntry.objects.all().delete()
+    RecentGame.objects.all().delete()
+    SiteStats.objects.all().delete()
+    DataGeneration.objects.bump()
+    AggregationRun.objects.all().delete()
+
+
 @transaction.atomic
 def wipe_games():
     Game.objects.all().delete()
+    wipe_derived()
     clear_player_and_clan_fields()
     reset_source_file_positions()
 
@@ -50,6 +66,7 @@ def wipe_games():
 @transaction.atomic
 def wipe_all_but_clans():
     Game.objects.all().delete()
+    wipe_derived()
     clear_player_and_clan_fields()
     reset_source_file_positions()
     Achievement.objects.all().delete()
@@ -64,6 +81,7 @@ def wipe_non_fixtures():
     Player.objects.all().delete()
     User.objects.all().delete()
     Game.objects.all().delete()
+    wipe_derived()
 
 
 @transaction.atomic
@@ -72,6 +90,7 @@ def wipe_all():
     Player.objects.all().delete()
     User.objects.all().delete()
     Game.objects.all().delete()
+    wipe_derived()
     Achievement.objects.all().delete()
     Conduct.objects.all().delete()
     Trophy.objects.all().delete()
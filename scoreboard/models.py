@@ -1,12 +1,22 @@
 from django.db import models
 from django.contrib.auth.models import User
+from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 from tnnt import settings
 from tnnt import dumplog_utils
+from tnnt import uniqdeaths
+from scoreboard import bitfields
+from scoreboard.streaks import StreakTracker
 
 # If adding any more models to this file, be sure to add a deletion for them in
 # wipe_db.py.
 
+# Maximum number of rows sent in a single INSERT by the bulk ingest paths.
+BULK_BATCH_SIZE = 1000
+
+# How many of the most recent games and wins the homepage shows.
+RECENT_GAMES = 10
+
 class Trophy(models.Model):
     # The "perma-trophy" structure. Loaded from config.
     name        = models.CharField(max_length=64, unique=True)
@@ -89,15 +99,9 @@ class Clan(LeaderboardBaseFields):
     # FUTURE TODO: perhaps there should be:
     # admins = models.ManyToManyField(Player)
     # instead of Player having a clan_admin field
-
-class Streak:
-    # This is NOT a database model!
-    # It is a simple storage class for streak information that can be used in
-    # aggregation and relayed to the frontend.
-
-    def __init__(self, singlegame):
-        self.games       = [ singlegame ] # list of Games in the streak
-        self.continuable = True           # whether it can be continued
+    # set when a member joins or leaves, or a member gets new games, so that
+    # `aggregate --incremental` knows to recompute this clan
+    dirty    = models.BooleanField(default=True, db_index=True)
 
 class Player(LeaderboardBaseFields):
     name       = models.CharField(max_length=32, unique=True)
@@ -107,47 +111,26 @@ class Player(LeaderboardBaseFields):
     invites    = models.ManyToManyField(Clan, related_name='invitees')
     # link to User model for web logins
     user       = models.OneToOneField(User, on_delete=models.PROTECT, null=True)
+    # set by ingest when this player gets new games, so that
+    # `aggregate --incremental` knows to recompute them
+    dirty      = models.BooleanField(default=True, db_index=True)
+    # saved StreakTracker state, so aggregation can carry on from where it
+    # left off instead of going through all of the player's games again
+    streak_state = models.JSONField(null=True)
 
     # Compute this player's streaks, and return them as a list of Streaks
     # containing the games in the streak and whether they can be continued.
-    def get_streaks(self):
-        # Due to multiple servers, start and end times can overlap. The
-        # candidate game for continuing a streak is the first one started after
-        # an ascension.
-        # If a game is eligible to continue MULTIPLE streaks at once (possible
-        # with server shenanigans), it will continue only the oldest of those
-        # streaks (i.e. the one that comes first in streaks), and kill the rest.
-        #
-        # ASSUMPTION: No two Games of the same player will ever have the same
-        # starttime. If they did, it would be possible to have two candidate
-        # games for continuing the streak and not know which one to count.
-
-        streaks = []
-        for g in Game.objects.filter(player=self).order_by('starttime').all():
-            extended_or_killed_streak = False
-            # first: will this game extend/kill a streak?
-            for strk in streaks:
-                if strk.continuable == False:
-                    # this streak is dead, ignore it
-                    continue
-                if strk.games[-1].endtime < g.starttime:
-                    extended_or_killed_streak = True
-                    if g.won == False:
-                        # streak is killed
-                        strk.continuable = False
-                        continue # it could still kill other streaks
-                    else:
-                        # streak is extended
-                        strk.games.append(g)
-                        # and stop looking for other streaks to extend
-                        break
-
-            # if we didn't extend or kill a streak, and the game is a win, we start one
-            if (not extended_or_killed_streak) and g.won:
-                streaks.append(Streak(g))
-
-        # filter out "streaks" of only 1 game, which are not streaks yet
-        return [ strk for strk in streaks if len(strk.games) >= 2 ]
+    # See scoreboard/streaks.py for how streaks work across servers.
+    # games, if given, is this player's games already in starttime order (any
+    # objects with id, starttime, endtime and won will do); otherwise they are
+    # fetched.
+    def get_streaks(self, games=None):
+        if games is None:
+            games = Game.objects.filter(player=self).order_by('starttime')
+        tracker = StreakTracker(keep_games=True)
+        for g in games:
+            tracker.add(g)
+        return tracker.get_streaks()
 
 class Source(models.Model):
     # Information about a source of aggregate game data (e.g. an xlogfile).
@@ -169,33 +152,65 @@ class Source(models.Model):
     # description = models.CharField(max_length=256)
     # website     = models.URLField(null=True)
 
+class DeathManager(models.Manager):
+    # Return a dict mapping each of the given normalized death strings to the
+    # id of its Death, creating any that don't exist yet.
+    def intern(self, names):
+        names = set(names)
+        ids = dict(self.filter(name__in=names).values_list('name', 'id'))
+        new_names = names - ids.keys()
+        if len(new_names) > 0:
+            self.bulk_create([ Death(name=name) for name in new_names ],
+                             batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+            ids.update(self.filter(name__in=new_names).values_list('name', 'id'))
+        return ids
+
+class Death(models.Model):
+    # A death as it counts for unique deaths: the normalized form of one or
+    # more raw death strings (see tnnt/uniqdeaths.py). Each one is stored once
+    # and Games point at it, so counting unique deaths is a COUNT(DISTINCT).
+    name = models.CharField(max_length=256, unique=True)
+
+    objects = DeathManager()
+
 class GameManager(models.Manager):
     # TODO: why do we need this as a manager? Couldn't this logic just live in pollxlogs?
     # Post 2021 concern, unless this proves slow for some reason
     simple_fields = ['version', 'role', 'race', 'gender', 'align', 'points', 'turns', 'realtime', 'maxlvl', 'death',
                      'align0', 'gender0']
 
-    def from_xlog(self, source, xlog_dict):
+    # The set of xlog fields that game_kwargs() and the bitfield decoder look
+    # at, so parsers can skip the rest.
+    def xlog_fields(self):
+        return set(self.simple_fields) | {'name', 'starttime', 'endtime'} \
+            | bitfields.get_decoder().xlog_fields()
+
+    # Build the keyword arguments for a new Game from a parsed xlog line, minus
+    # the player (which the caller has to resolve). Returns None if the line
+    # should not become a Game at all.
+    def game_kwargs(self, source, xlog_dict):
         # TODO: validate xlog_dict contains some set of 'required_fields'
-        # simple fields get keyed directly to keyword args to self.create()
+        # simple fields get keyed directly to keyword args to Game()
         kwargs = {'source': source}
         for key in self.simple_fields:
             kwargs[key] = xlog_dict[key]
 
         # filter explore/wizmode games
-        # post 2021 TODO: do something about magic numbers in this method
-        if xlog_dict['flags'] & 0x1 or xlog_dict['flags'] & 0x2:
+        if bitfields.test_mask(xlog_dict, 'debug'):
             return None
 
-        # assign 'won' boolean
-        # post 2021 TODO: do something about magic numbers in this method
-        if xlog_dict['achieve'] & 0x100:
-            kwargs['won'] = True
+        # assign 'won' and 'mines_soko' booleans
+        kwargs['won'] = bitfields.test_mask(xlog_dict, 'won')
+        kwargs['mines_soko'] = bitfields.test_mask(xlog_dict, 'mines_soko')
 
-        # ditto for mines/soko
-        # post 2021 TODO: do something about magic numbers in this method
-        if xlog_dict['achieve'] & 0x600:
-            kwargs['mines_soko'] = True
+        # the raw bitfields, and how many conducts and achievements they hold
+        # (counted from the bits, as insert_pending does the decoding)
+        for field in bitfields.GAME_BITFIELDS:
+            kwargs[field] = bitfields.to_signed64(xlog_dict.get(field, 0))
+        decoder = bitfields.get_decoder()
+        packed = bitfields.pack(kwargs[field] for field in bitfields.GAME_BITFIELDS)
+        kwargs['nconducts'] = decoder.conducts.count(packed)
+        kwargs['nachievements'] = decoder.achievements.count(packed)
 
         # time/duration information
         kwargs['starttime'] = datetime.fromtimestamp(xlog_dict['starttime'], timezone.utc)
@@ -209,23 +224,183 @@ class GameManager(models.Manager):
             or kwargs['endtime'] > settings.TOURNAMENT_END):
             return None
 
-        # find/create player
-        try:
-            player = Player.objects.get(name=xlog_dict['name'])
-        except Player.DoesNotExist:
-            player = Player(name=xlog_dict['name'], clan=None, clan_admin=False)
-            player.save()
-        kwargs['player'] = player
+        return kwargs
 
-        game = self.create(**kwargs)
-        for conduct in Conduct.objects.all():
-            if conduct.xlogfield in xlog_dict and xlog_dict[conduct.xlogfield] & (1 << conduct.bit):
-                game.conducts.add(conduct)
-        for achieve in Achievement.objects.all():
-            if achieve.xlogfield in xlog_dict and xlog_dict[achieve.xlogfield] & (1 << achieve.bit):
-                game.achievements.add(achieve)
+    def from_xlog(self, source, xlog_dict):
+        # Single-line convenience wrapper around from_xlog_batch.
+        games = self.from_xlog_batch(source, [xlog_dict])
+        return games[0] if games else None
+
+    # Create Games for a whole list of parsed xlog lines at once, and return
+    # the list of Games created. Lines that don't produce a Game are skipped, as
+    # are lines for Games that already exist (same player, starttime and
+    # source), so importing the same part of an xlog twice is harmless.
+    # Compared to calling from_xlog once per line this does a constant number of
+    # queries per batch: one each to find existing players and existing Games,
+    # one bulk insert each for new players, Games, and the conduct/achievement
+    # through tables, and one to read back the ids of the new Games (plus one or
+    # two to intern the normalized deaths).
+    def from_xlog_batch(self, source, xlog_dicts):
+        pending = []
+        for xlog_dict in xlog_dicts:
+            kwargs = self.game_kwargs(source, xlog_dict)
+            if kwargs is not None:
+                pending.append((xlog_dict, kwargs))
+        return self.insert_pending(source, pending)
+
+    # The database half of from_xlog_batch, for callers that have already run
+    # game_kwargs() themselves (e.g. in other processes). pending is a list of
+    # (xlog_dict, kwargs) pairs, where kwargs came from game_kwargs(source, ...).
+    def insert_pending(self, source, pending):
+        if len(pending) == 0:
+            return []
+
+        # find/create players
+        names = set(xlog_dict['name'] for xlog_dict, _ in pending)
+        players = { plr.name: plr for plr in Player.objects.filter(name__in=names) }
+        new_names = names - players.keys()
+        if len(new_names) > 0:
+            Player.objects.bulk_create([ Player(name=name, clan=None, clan_admin=False)
+                                         for name in new_names ],
+                                       batch_size=BULK_BATCH_SIZE,
+                                       ignore_conflicts=True)
+            new_players = { plr.name: plr for plr in Player.objects.filter(name__in=new_names) }
+            players.update(new_players)
+            SiteStats.objects.add(numplayers=len(new_players))
+
+        # normalize the deaths for unique deaths; rejected ones are left null
+        normalized = { death: uniqdeaths.normalized_or_none(death)
+                       for death in set(kwargs['death'] for _, kwargs in pending) }
+        death_ids = Death.objects.intern(name for name in normalized.values() if name is not None)
+
+        # drop Games that are already in the database, or repeated in this
+        # batch (exact duplicate lines do occur in xlogs)
+        games = [ Game(player=players[xlog_dict['name']],
+                       normalized_death_id=death_ids.get(normalized[kwargs['death']]),
+                       **kwargs)
+                  for xlog_dict, kwargs in pending ]
+        seen = set(self.filter(source=source,
+                               player__in=set(g.player_id for g in games),
+                               starttime__in=set(g.starttime for g in games))
+                       .values_list('player_id', 'starttime'))
+        new_games = []
+        new_xlog_dicts = []
+        for g, (xlog_dict, _) in zip(games, pending):
+            if (g.player_id, g.starttime) not in seen:
+                seen.add((g.player_id, g.starttime))
+                new_games.append(g)
+                new_xlog_dicts.append(xlog_dict)
+        if len(new_games) == 0:
+            return []
+
+        # ignore_conflicts covers anything inserted since the check above; it
+        # also means no backend hands back the new ids, so read them back.
+        self.bulk_create(new_games, batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+        ids = { (plr_id, stt): pk for pk, plr_id, stt in
+                self.filter(source=source,
+                            player__in=set(g.player_id for g in new_games),
+                            starttime__in=set(g.starttime for g in new_games))
+                    .values_list('id', 'player_id', 'starttime') }
+        for g in new_games:
+            g.pk = ids[(g.player_id, g.starttime)]
+
+        game_conducts, game_achievements = \
+            bitfields.get_decoder().decode_batch([ g.pk for g in new_games ], new_xlog_dicts)
+        Game.conducts.through.objects.bulk_create(
+            [ Game.conducts.through(game_id=g, conduct_id=c) for g, c in game_conducts ],
+            batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+        Game.achievements.through.objects.bulk_create(
+            [ Game.achievements.through(game_id=g, achievement_id=a) for g, a in game_achievements ],
+            batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+
+        # the homepage's counts and recent games
+        SiteStats.objects.add(numgames=len(new_games))
+        RecentGame.objects.offer(new_games, game_conducts)
+
+        # flag the players and clans that need re-aggregating, and the cached
+        # pages as stale
+        dirty_ids = set(g.player_id for g in new_games)
+        Player.objects.filter(id__in=dirty_ids, dirty=False).update(dirty=True)
+        Clan.objects.filter(player__id__in=dirty_ids, dirty=False).update(dirty=True)
+        DataGeneration.objects.bump()
+
+        return new_games
+
+class UniqueDeath(models.Model):
+    # The first Game in which a player or a clan got a given Death. Exactly
+    # one of player and clan is set. first marks the row that got there before
+    # every other player (or clan) did. Written by the aggregate command; the
+    # pages only ever read it.
+    death   = models.ForeignKey(Death, on_delete=models.CASCADE)
+    player  = models.ForeignKey(Player, null=True, on_delete=models.CASCADE)
+    clan    = models.ForeignKey(Clan, null=True, on_delete=models.CASCADE)
+    game    = models.ForeignKey('Game', on_delete=models.CASCADE)
+    endtime = models.DateTimeField() # same as game.endtime, saves a join
+    first   = models.BooleanField(default=False, db_index=True)
+
+class LeaderboardEntry(models.Model):
+    # One line of one of the leaderboards (see scoreboard.leaderboards), for
+    # a player or a clan, ready to be shown as it is. Written by the aggregate
+    # command; the leaderboards page only ever reads it.
+    board     = models.CharField(max_length=16)
+    is_clan   = models.BooleanField()
+    # 1-based; ties are broken by who got to the stat first
+    rank      = models.IntegerField()
+    player    = models.ForeignKey(Player, null=True, on_delete=models.CASCADE)
+    clan      = models.ForeignKey(Clan, null=True, on_delete=models.CASCADE)
+    name      = models.CharField(max_length=128)
+    stat      = models.CharField(max_length=64) # formatted for display
+    # what the board is sorted by (stat as a number; times and durations in
+    # microseconds), and when the player or clan got to it
+    value     = models.BigIntegerField()
+    reached   = models.DateTimeField(null=True)
+    dumplog   = models.CharField(max_length=256, null=True)
 
-        return game
+    class Meta:
+        indexes = [ models.Index(fields=['board', 'is_clan', 'rank']) ]
+
+class AggregationWatermark(models.Model):
+    # Single row recording how far aggregation has got. Every Game with an id
+    # up to last_game_id has been aggregated; incremental aggregation treats the
+    # players of any newer Game as dirty even if nothing flagged them (e.g.
+    # Games added through the admin).
+    last_game_id     = models.BigIntegerField(default=0)
+    last_full        = models.DateTimeField(null=True)
+    last_incremental = models.DateTimeField(null=True)
+
+class AggregationRun(models.Model):
+    # One row per run of the aggregate command, to keep an eye on how long
+    # aggregation takes as the tournament goes on. report has the per-phase
+    # figures and the slowest players and clans (see AggregationStats).
+    started     = models.DateTimeField()
+    incremental = models.BooleanField()
+    workers     = models.IntegerField()
+    players     = models.IntegerField() # how many were recomputed
+    clans       = models.IntegerField()
+    seconds     = models.FloatField()
+    queries     = models.IntegerField()
+    sql_seconds = models.FloatField()
+    report      = models.JSONField()
+
+class DataGenerationManager(models.Manager):
+    # Return the current generation (0 before anything has bumped it).
+    def current(self):
+        return self.filter(pk=1).values_list('generation', flat=True).first() or 0
+
+    # Move on to a new generation. Inside a transaction, the new generation
+    # only becomes visible when it commits, along with the changes that
+    # caused it.
+    def bump(self):
+        if self.filter(pk=1).update(generation=models.F('generation') + 1) == 0:
+            self.get_or_create(pk=1, defaults={ 'generation': 1 })
+
+class DataGeneration(models.Model):
+    # Single row counting changes to what the public pages show: ingest,
+    # aggregation and clan changes bump it. tnnt/pagecache.py keys its cached
+    # pages on it, so a bump makes every one of them stale at once.
+    generation = models.BigIntegerField(default=0)
+
+    objects = DataGenerationManager()
 
 class Game(models.Model):
     # Represents a single game: a single line in the xlog, a single dumplog, etc.
@@ -251,6 +426,9 @@ class Game(models.Model):
     starttime    = models.DateTimeField()
     endtime      = models.DateTimeField()
     death        = models.CharField(max_length=256)
+    # death as it counts for unique deaths, or null if it doesn't count (e.g.
+    # quit); filled in at ingest, and by renormalize_deaths
+    normalized_death = models.ForeignKey(Death, null=True, on_delete=models.SET_NULL)
     align0       = models.CharField(max_length=16, null=True)
     gender0      = models.CharField(max_length=16, null=True)
 
@@ -259,6 +437,19 @@ class Game(models.Model):
     # finished Mines/Sokoban.
     won          = models.BooleanField(default=False)
     mines_soko   = models.BooleanField(default=False)
+    # Likewise, so that leaderboards and aggregation don't have to go through
+    # the conducts and achievements tables: how many of each the game has, and
+    # the bitfields they were decoded from (bitfields.GAME_BITFIELDS, stored
+    # as signed 64-bit ints).
+    nconducts     = models.IntegerField(default=0)
+    nachievements = models.IntegerField(default=0)
+    conduct       = models.BigIntegerField(default=0)
+    achieve       = models.BigIntegerField(default=0)
+    tnntachieve0  = models.BigIntegerField(default=0)
+    tnntachieve1  = models.BigIntegerField(default=0)
+    tnntachieve2  = models.BigIntegerField(default=0)
+    tnntachieve3  = models.BigIntegerField(default=0)
+    tnntachieve4  = models.BigIntegerField(default=0)
 
     # not necessary for tnnt but may re-introduce for NHS
     # deathlev     = models.IntegerField(null=True)
@@ -278,6 +469,12 @@ class Game(models.Model):
     # using Game.objects.from_xlog()
     objects = GameManager()
 
+    class Meta:
+        # The same game read twice from an xlog must not become two Games.
+        # ASSUMPTION: No two Games of the same player will have the same
+        # starttime on the same server.
+        unique_together = ('player', 'starttime', 'source')
+
     # Return a URL to the dumplog of this game.
     # ASSUMPTION: No two Games of the same player will have the same starttime.
     def get_dumplog(self):
@@ -292,4 +489,125 @@ class Game(models.Model):
     def rrga(self):
         return '-'.join([self.role, self.race, self.gender0, self.align0])
 
+class SiteStatsManager(models.Manager):
+    # Return the SiteStats, or all zeros if nothing has written them yet.
+    def current(self):
+        return self.filter(pk=1).first() or SiteStats()
+
+    # Add to some of the counts, e.g. add(numgames=3).
+    def add(self, **counts):
+        updates = { field: models.F(field) + n for field, n in counts.items() }
+        if self.filter(pk=1).update(**updates) == 0:
+            self.get_or_create(pk=1, defaults=counts)
+
+    # Count everything again from scratch.
+    def recount(self):
+        aggr = Player.objects.aggregate(models.Sum('games_scummed'), models.Sum('wins'))
+        self.update_or_create(pk=1, defaults={
+            'numclans':     Clan.objects.count(),
+            'numplayers':   Player.objects.count(),
+            'numgames':     Game.objects.count(),
+            'numscums':     aggr['games_scummed__sum'] or 0,
+            'numascs':      aggr['wins__sum'] or 0,
+            'numascenders': Player.objects.filter(wins__gt=0).count(),
+        })
+
+class SiteStats(models.Model):
+    # Single row of the general statistics on the homepage. Ingest adds its new
+    # games and players, clan management its new and disbanded clans, and
+    # aggregation counts everything again (which is where the scums and
+    # ascensions come from, as they do for the Players).
+    numclans     = models.IntegerField(default=0)
+    numplayers   = models.IntegerField(default=0)
+    numgames     = models.IntegerField(default=0)
+    numscums     = models.IntegerField(default=0)
+    numascs      = models.IntegerField(default=0)
+    numascenders = models.IntegerField(default=0)
+
+    objects = SiteStatsManager()
+
+class RecentGameManager(models.Manager):
+    # Offer some new Games (with their player and source set) to both buffers.
+    # conducts is a list of (game id, conduct id) pairs for them. Only the Games
+    # that are more recent than what the buffers already hold get in.
+    def offer(self, games, conducts):
+        shortnames = None
+        for won_only in (False, True):
+            candidates = sorted((g for g in games if g.won or not won_only),
+                                key=lambda g: g.endtime, reverse=True)[:RECENT_GAMES]
+            if len(candidates) == 0:
+                continue
+            # the endtime of the game in each slot in use
+            ends = dict(self.filter(won_only=won_only).values_list('slot', 'endtime'))
+            entering = {}
+            for g in candidates:
+                free = [ slot for slot in range(RECENT_GAMES) if slot not in ends ]
+                if len(free) > 0:
+                    slot = free[0]
+                else:
+                    slot = min(ends, key=ends.get)
+                    if g.endtime <= ends[slot]:
+                        # and so are the rest of the candidates
+                        break
+                ends[slot] = g.endtime
+                entering[slot] = g
+            if len(entering) == 0:
+                continue
+            if shortnames is None:
+                shortnames = dict(Conduct.objects.values_list('id', 'shortname'))
+            game_conducts = defaultdict(list)
+            for game_id, conduct_id in sorted(conducts):
+                game_conducts[game_id].append(shortnames[conduct_id])
+            self.filter(won_only=won_only, slot__in=entering.keys()).delete()
+            self.bulk_create([ RecentGame.from_game(g, won_only, slot, game_conducts[g.id])
+                               for slot, g in entering.items() ])
+
+    # Fill both buffers again from the Games, e.g. after some were deleted.
+    def rebuild(self):
+        rows = []
+        for won_only in (False, True):
+            game_qs = Game.objects.select_related('player', 'source').order_by('-endtime')
+            if won_only:
+                game_qs = game_qs.filter(won=True)
+            games = list(game_qs[:RECENT_GAMES])
+            game_conducts = defaultdict(list)
+            for game_id, shortname in Game.conducts.through.objects \
+                    .filter(game__in=[ g.id for g in games ]).order_by('conduct_id') \
+                    .values_list('game_id', 'conduct__shortname'):
+                game_conducts[game_id].append(shortname)
+            rows.extend(RecentGame.from_game(g, won_only, slot, game_conducts[g.id])
+                        for slot, g in enumerate(games))
+        self.all().delete()
+        self.bulk_create(rows)
+
+class RecentGame(models.Model):
+    # The homepage's most recent games and most recent wins: two ring buffers
+    # of RECENT_GAMES slots, where a new Game takes the slot of the one that
+    # ended longest ago. Ingest offers them its new Games, and full aggregation
+    # fills them again from scratch. They keep what the game listings show
+    # (see game_rows in tnnt/views.py), so the homepage needn't touch Games.
+    won_only   = models.BooleanField() # which of the two buffers
+    slot       = models.IntegerField()
+    game       = models.ForeignKey(Game, on_delete=models.CASCADE)
+    won        = models.BooleanField()
+    playername = models.CharField(max_length=32)
+    rrga       = models.CharField(max_length=64)
+    turns      = models.BigIntegerField()
+    points     = models.BigIntegerField(null=True)
+    wallclock  = models.DurationField(null=True)
+    endtime    = models.DateTimeField()
+    death      = models.CharField(max_length=256)
+    dumplog    = models.CharField(max_length=256)
+    conducts   = models.TextField() # shortnames, space separated
+
+    objects = RecentGameManager()
 
+    class Meta:
+        unique_together = ('won_only', 'slot')
+
+    @classmethod
+    def from_game(cls, game, won_only, slot, conducts):
+        return cls(won_only=won_only, slot=slot, game=game, won=game.won,
+                   playername=game.player.name, rrga=game.rrga(), turns=game.turns,
+                   points=game.points, wallclock=game.wallclock, endtime=game.endtime,
+                   death=game.death, dumplog=game.get_dumplog(), conducts=' '.join(conducts))
@@ -1,9 +1,12 @@
+import mmap
+import os
+import re
 from rest_framework.parsers import BaseParser
 
-dec_fields = ['points', 'turns', 'realtime', 'maxlvl', 'starttime', 'endtime']
-hex_fields = [
+dec_fields = {'points', 'turns', 'realtime', 'maxlvl', 'starttime', 'endtime'}
+hex_fields = {
     'flags', 'achieve', 'conduct', 'tnntachieve0', 'tnntachieve1', 'tnntachieve2', 'tnntachieve3', 'tnntachieve4'
-]
+}
 
 
 def convert_if_numeric(key, value):
@@ -30,13 +33,164 @@ class XlogParser(BaseParser):
         each numeric value is converted to an integer with int(val, 0). This could
         possibly cause issues with fields where we're using bigint in the database...
         """
-        return [
-            {
-                k: convert_if_numeric(k, v)
-                for k, v in [
-                    i.split(self.separator)
-                    for i in line.rstrip().split(self.delimiter)
-                ]
-            }
-            for line in stream.readlines()
-        ]
\ No newline at end of file
+        return [ self.parse_line(line) for line in stream.readlines() ]
+
+    def parse_line(self, line):
+        """
+        Parse a single xlogfile line (str) into a dict xlog_entry, as described
+        in parse().
+        """
+        return {
+            k: convert_if_numeric(k, v)
+            for k, v in [
+                i.split(self.separator)
+                for i in line.rstrip().split(self.delimiter)
+            ]
+        }
+
+    def iterparse(self, stream):
+        """
+        Streaming version of parse(), which reads and parses one line at a time
+        so memory use doesn't depend on the size of the file.
+        Input: filehandle stream opened in binary mode, e.g. open('foo.xlog', 'rb'),
+        positioned at the start of a line.
+        Output: generator of tuples (xlog_entry, end_pos), where xlog_entry is
+        as in parse() and end_pos is the byte offset just past the line, i.e.
+        where reading should resume once this entry has been stored.
+        A final line with no trailing newline is assumed to still be in the
+        middle of being written (or downloaded), and is not consumed.
+        Ingest reads local files with XlogMmapParser instead; this is kept as
+        the baseline that `benchmark --parsers` times it against.
+        """
+        pos = stream.tell()
+        for line in iter(stream.readline, b''):
+            if not line.endswith(b'\n'):
+                break
+            pos += len(line)
+            yield self.parse_line(line.decode('utf-8')), pos
+
+
+class XlogMmapParser:
+    """
+    Faster alternative to XlogParser.iterparse() for xlogfiles on local disk.
+    The file is memory mapped and each line is tokenized as bytes; only the
+    fields asked for are converted (numbers straight from bytes, strings
+    decoded from UTF-8), and all others are dropped without being decoded.
+    Input: fields, an iterable of the xlogfile field names wanted, or None for
+    all of them.
+    """
+    delimiter = b'\t'
+    separator = b'='
+
+    def __init__(self, fields=None):
+        self.keep_all = fields is None
+        if fields is None:
+            fields = dec_fields | hex_fields
+        # bytes key => (str key, function converting the bytes value)
+        self.dispatch = {}
+        for key in fields:
+            if key in dec_fields:
+                conv = int
+            elif key in hex_fields:
+                conv = lambda v: int(v, 16)
+            else:
+                conv = bytes.decode
+            self.dispatch[key.encode()] = (key, conv)
+
+    def parse_line(self, line):
+        """
+        Parse a single xlogfile line (bytes, without its newline) into a dict
+        xlog_entry, as in XlogParser.parse().
+        """
+        entry = {}
+        for token in line.rstrip().split(self.delimiter):
+            key, _, value = token.partition(self.separator)
+            spec = self.dispatch.get(key)
+            if spec is not None:
+                entry[spec[0]] = spec[1](value)
+            elif self.keep_all:
+                entry[key.decode()] = value.decode()
+        return entry
+
+    def iterparse_path(self, path, start=0, end=None):
+        """
+        Same output as XlogParser.iterparse(), for the lines of the file at
+        path starting in the byte range [start, end) (end defaults to the end of
+        the file). start must be at the start of a line. As with iterparse(), a
+        final line with no trailing newline is not consumed.
+        """
+        with open(path, 'rb') as xlog_file:
+            size = os.fstat(xlog_file.fileno()).st_size
+            if end is None or end > size:
+                end = size
+            if start >= end:
+                # (mmap also refuses to map an empty file)
+                return
+            with mmap.mmap(xlog_file.fileno(), 0, access=mmap.ACCESS_READ) as xlog_map:
+                pos = start
+                while pos < end:
+                    newline = xlog_map.find(b'\n', pos)
+                    if newline == -1:
+                        break
+                    yield self.parse_line(xlog_map[pos:newline]), newline + 1
+                    pos = newline + 1
+
+
+endtime_re = re.compile(rb'(?:^|\t)endtime=(\d+)')
+
+
+def line_endtime(line):
+    """
+    Return the endtime field of a raw (bytes) xlogfile line as an int, without
+    parsing the rest of the line, or None if it has no endtime.
+    """
+    m = endtime_re.search(line)
+    return int(m.group(1)) if m else None
+
+
+def bisect_endtime(stream, timestamp, lo, hi):
+    """
+    Binary search a binary stream of xlogfile lines for the first line whose
+    endtime is at least timestamp.
+    This relies on lines being appended to an xlogfile as games end, so that
+    endtime never decreases through the file.
+    Input: stream opened in binary mode, unix timestamp, and byte offsets lo and
+    hi, both of which must be at the start of a line (or hi at the end of the
+    file).
+    Output: byte offset of the start of the first line in [lo, hi) with endtime
+    >= timestamp, or hi if there is none. A trailing incomplete line counts as
+    not yet readable, i.e. as if its endtime were >= timestamp.
+    """
+    def before(line):
+        if not line.endswith(b'\n'):
+            return False
+        endtime = line_endtime(line)
+        return endtime is None or endtime < timestamp
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if mid == lo:
+            start = lo
+        else:
+            # realign to the first line starting at or after mid
+            stream.seek(mid - 1)
+            stream.readline()
+            start = stream.tell()
+        if start >= hi:
+            # no line starts in [mid, hi), so only a couple of lines are left
+            break
+        stream.seek(start)
+        line = stream.readline()
+        if before(line):
+            lo = start + len(line)
+        else:
+            hi = start
+
+    # finish off whatever is left line by line
+    stream.seek(lo)
+    while lo < hi:
+        line = stream.readline()
+        if not before(line):
+            break
+        lo += len(line)
+    return lo
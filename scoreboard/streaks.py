@@ -0,0 +1,144 @@
+# Streak computation.
+#
+# A streak is a run of consecutive wins by one player. Due to multiple
+# servers, start and end times can overlap, so "consecutive" is defined per
+# streak: the candidate game for continuing a streak is the first game started
+# after the streak's last game ended. A losing candidate kills the streak; a
+# game which started before the streak's last game ended has no effect on it.
+# If a game is eligible to continue MULTIPLE streaks at once (possible with
+# server shenanigans), it will continue only the oldest of those streaks, and
+# kill the rest if it is a loss.
+#
+# ASSUMPTION: No two Games of the same player will ever have the same
+# starttime. If they did, it would be possible to have two candidate games for
+# continuing the streak and not know which one to count.
+import heapq
+
+
+class Streak:
+    # This is NOT a database model!
+    # It is a simple storage class for streak information that can be used in
+    # aggregation and relayed to the frontend.
+
+    def __init__(self, singlegame):
+        self.games       = [ singlegame ] # list of Games in the streak
+        self.continuable = True           # whether it can be continued
+
+
+class _OpenStreak:
+    # A streak that can still be continued, as StreakTracker keeps it. streak
+    # is the corresponding Streak, if the tracker is keeping games.
+    __slots__ = ('index', 'length', 'last_end', 'streak')
+
+    def __init__(self, index, length, last_end, streak=None):
+        self.index = index
+        self.length = length
+        self.last_end = last_end
+        self.streak = streak
+
+
+class StreakTracker:
+    # Finds the streaks in one player's games, which have to be fed to add()
+    # in starttime order. Every game is looked at once: open streaks wait in a
+    # heap ordered by the end of their last game until a game starts after
+    # that, at which point they become eligible to be continued and move to a
+    # second heap ordered by age. Since games come in starttime order, a
+    # streak stays eligible until the next game decides it.
+    #
+    # The tracker only needs the open streaks and a few counters to carry on,
+    # so its state can be saved (state()) and later resumed with more games
+    # (resume()) without going through the earlier ones again.
+
+    def __init__(self, keep_games=False):
+        # with keep_games, Streak objects with their Games are built up in
+        # streaks; otherwise only lengths are tracked
+        self.keep_games = keep_games
+        self.streaks = []
+        self.waiting = []     # heap of (last_end, index, _OpenStreak)
+        self.eligible = []    # heap of (index, _OpenStreak)
+        self.nstreaks = 0     # streaks started so far, including 1-game ones
+        self.longest = 0      # length of the longest streak of 2+ games
+        self.longest_at = None # endtime timestamp of the game that got there
+        self.ngames = 0       # games fed so far
+        self.last_game = None # (starttime, id) of the last game fed
+
+    def add(self, game):
+        start = game.starttime.timestamp()
+        end = game.endtime.timestamp()
+        self.ngames += 1
+        self.last_game = (start, game.id)
+
+        while len(self.waiting) > 0 and self.waiting[0][0] < start:
+            _, index, strk = heapq.heappop(self.waiting)
+            heapq.heappush(self.eligible, (index, strk))
+
+        if len(self.eligible) > 0:
+            if game.won:
+                # the oldest eligible streak is extended
+                index, strk = heapq.heappop(self.eligible)
+                strk.length += 1
+                strk.last_end = end
+                if strk.streak is not None:
+                    strk.streak.games.append(game)
+                if strk.length > self.longest:
+                    self.longest = strk.length
+                    self.longest_at = end
+                heapq.heappush(self.waiting, (end, index, strk))
+            else:
+                # every eligible streak is killed
+                for _, strk in self.eligible:
+                    if strk.streak is not None:
+                        strk.streak.continuable = False
+                self.eligible = []
+        elif game.won:
+            # nothing extended or killed, and the game is a win: start a streak
+            streak = None
+            if self.keep_games:
+                streak = Streak(game)
+                self.streaks.append(streak)
+            heapq.heappush(self.waiting, (end, self.nstreaks,
+                                          _OpenStreak(self.nstreaks, 1, end, streak)))
+            self.nstreaks += 1
+
+    # Return the Streaks of 2 or more games, oldest first. Needs keep_games.
+    def get_streaks(self):
+        # filter out "streaks" of only 1 game, which are not streaks yet
+        return [ strk for strk in self.streaks if len(strk.games) >= 2 ]
+
+    # Return the tracker's state as something JSON-serializable.
+    def state(self):
+        open_streaks = [ strk for _, _, strk in self.waiting ] \
+            + [ strk for _, strk in self.eligible ]
+        return {
+            'ngames': self.ngames,
+            'last_game': self.last_game,
+            'nstreaks': self.nstreaks,
+            'longest': self.longest,
+            'longest_at': self.longest_at,
+            'open': sorted([ strk.index, strk.length, strk.last_end ]
+                           for strk in open_streaks),
+        }
+
+    # Return a tracker that has been fed all of games (a player's games in
+    # starttime order), starting from a saved state if that state covers a
+    # prefix of games. If it doesn't (e.g. a game came in that started before
+    # the last one the state saw), all of games are gone through again, as
+    # they are for a state saved before longest_at was.
+    @classmethod
+    def resume(cls, state, games):
+        tracker = cls()
+        if state is not None and 'longest_at' in state and state['ngames'] <= len(games):
+            prev = games[state['ngames'] - 1] if state['ngames'] > 0 else None
+            if prev is None or [ prev.starttime.timestamp(), prev.id ] == list(state['last_game']):
+                tracker.ngames = state['ngames']
+                tracker.last_game = state['last_game']
+                tracker.nstreaks = state['nstreaks']
+                tracker.longest = state['longest']
+                tracker.longest_at = state['longest_at']
+                # whether they are eligible is sorted out by the next add()
+                tracker.waiting = [ (last_end, index, _OpenStreak(index, length, last_end))
+                                    for index, length, last_end in state['open'] ]
+                heapq.heapify(tracker.waiting)
+        for g in games[tracker.ngames:]:
+            tracker.add(g)
+        return tracker
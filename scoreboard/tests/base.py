@@ -0,0 +1,103 @@
+# Shared setup for the scoreboard tests: the static fixtures, and test.xlog
+# (at the top of the repo) as a Source, inside a tournament window its games
+# fall in.
+from django.test import TestCase, TransactionTestCase
+from django.core.cache import caches
+from scoreboard import bitfields
+from scoreboard.models import Source
+from tnnt import pagecache, settings
+from datetime import datetime, timezone
+from unittest import mock
+import importlib
+import os
+import sys
+import tempfile
+
+TEST_XLOG = os.path.join(settings.BASE_DIR, 'test.xlog')
+
+# test.xlog holds games from TNNT 2020
+TEST_TOURNAMENT_START = datetime.fromisoformat('2020-11-01T00:00:00+00:00')
+TEST_TOURNAMENT_END   = datetime.fromisoformat('2020-12-01T00:00:00+00:00')
+
+# Modules that took their own copy of the tournament window from settings.
+TOURNAMENT_WINDOW_MODULES = [
+    'tnnt.settings',
+    'scoreboard.management.commands.pollxlogs',
+    'scoreboard.management.commands.backfill',
+]
+
+# Modules that look things up from the static fixtures once, when they are
+# imported.
+FIXTURE_TABLE_MODULES = [
+    'scoreboard.management.commands.aggregate',
+]
+
+
+# Return the lines of test.xlog, with their newlines.
+def test_xlog_lines():
+    with open(TEST_XLOG) as xlog_file:
+        return xlog_file.readlines()
+
+
+# Bring everything built from the fixtures up to date with the ones just
+# loaded: their rows get new ids every time they are loaded, so anything
+# built from an earlier load is out of date.
+def reload_fixture_tables():
+    bitfields.get_decoder(reload=True)
+    for name in FIXTURE_TABLE_MODULES:
+        if name in sys.modules:
+            importlib.reload(sys.modules[name])
+
+
+class ScoreboardTestMixin:
+    # Loads the fixtures, and puts the tournament in November 2020 with clan
+    # freeze not yet in effect. xlog() sets up a Source reading from a
+    # temporary xlog file.
+    fixtures = ['achievements', 'conducts', 'trophies']
+
+    def setUp(self):
+        window = { 'TOURNAMENT_START': TEST_TOURNAMENT_START,
+                   'TOURNAMENT_END': TEST_TOURNAMENT_END }
+        for name in TOURNAMENT_WINDOW_MODULES:
+            module = importlib.import_module(name)
+            patcher = mock.patch.multiple(module, **{ attr: value for attr, value in window.items()
+                                                      if hasattr(module, attr) })
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(settings, 'CLAN_FREEZE_TIME',
+                                    datetime(9999, 1, 1, tzinfo=timezone.utc))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # pages cached by an earlier test can have the same generation
+        caches[pagecache.PAGE_CACHE].clear()
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+
+    # Create a Source whose local xlog (an absolute path, so XLOG_DIR doesn't
+    # come into it) holds lines, and return it. append_xlog() adds more.
+    def xlog(self, lines, server='test'):
+        path = os.path.join(self.workdir.name, server + '.xlog')
+        with open(path, 'w') as xlog_file:
+            xlog_file.writelines(lines)
+        return Source.objects.create(server=server, local_file=path, location=None,
+                                     last_check=TEST_TOURNAMENT_START, dumplog_fmt=
+                                     'https://example.org/%n1/%n/dumplog/%st.html')
+
+    def append_xlog(self, src, lines):
+        with open(src.local_file, 'a') as xlog_file:
+            xlog_file.writelines(lines)
+
+
+class ScoreboardTestCase(ScoreboardTestMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        reload_fixture_tables()
+
+
+class ScoreboardTransactionTestCase(ScoreboardTestMixin, TransactionTestCase):
+    # For tests of code that commits or closes the connection itself.
+
+    def setUp(self):
+        reload_fixture_tables()
+        super().setUp()
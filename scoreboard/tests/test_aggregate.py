@@ -0,0 +1,105 @@
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db.models import Count, Q
+from scoreboard.models import Player, Clan, UniqueDeath, LeaderboardEntry
+from .base import ScoreboardTestCase, test_xlog_lines
+
+# How many clans of how many players each the test tournament has.
+NCLANS = 6
+CLAN_SIZE = 4
+
+
+# Everything aggregation writes about the players and clans, as it would show
+# on the pages (by name rather than id, where the ids don't matter).
+def aggregate_snapshot():
+    fields = ['name', 'longest_streak', 'unique_deaths', 'unique_ascs', 'unique_achievements',
+              'games_over_1000_turns', 'games_scummed', 'total_games', 'wins',
+              'lowest_turncount_asc', 'fastest_realtime_asc', 'max_conducts_asc',
+              'max_achieves_game', 'min_score_asc', 'max_score_asc', 'first_asc']
+    return {
+        'players': list(Player.objects.order_by('name').values(*fields, 'clan__name')),
+        'clans': list(Clan.objects.order_by('name').values(*fields)),
+        'player trophies': sorted(Player.trophies.through.objects
+                                  .values_list('player__name', 'trophy__name')),
+        'clan trophies': sorted(Clan.trophies.through.objects
+                                .values_list('clan__name', 'trophy__name')),
+        'unique deaths': sorted(UniqueDeath.objects
+                                .values_list('death__name', 'player__name', 'clan__name',
+                                             'game_id', 'endtime', 'first'),
+                                key=repr),
+        'leaderboards': list(LeaderboardEntry.objects.order_by('board', 'is_clan', 'rank')
+                             .values_list('board', 'is_clan', 'rank', 'name', 'player__clan__name',
+                                          'stat', 'value', 'reached', 'dumplog')),
+    }
+
+
+class IncrementalAggregateTest(ScoreboardTestCase):
+    # An incremental run after new games and clan changes has to leave
+    # everything as a full run would.
+
+    # POST data to the clan management page as player.
+    def clanmgmt(self, player, **data):
+        if player.user is None:
+            player.user = User.objects.create(username=player.name)
+            player.save()
+        self.client.force_login(player.user)
+        self.client.post('/clanmgmt', data)
+        player.refresh_from_db()
+
+    # Run an incremental aggregate, and check that a full one changes nothing.
+    def assertIncrementalMatchesFull(self):
+        call_command('aggregate', incremental=True)
+        incremental = aggregate_snapshot()
+        call_command('aggregate')
+        self.assertEqual(incremental, aggregate_snapshot())
+
+    def test_incremental_matches_full(self):
+        lines = test_xlog_lines()
+        src = self.xlog(lines[:400])
+        call_command('pollxlogs')
+
+        # clans of CLAN_SIZE, the first of each its admin
+        players = list(Player.objects.order_by('name'))
+        clans = []
+        for i in range(NCLANS):
+            clan = Clan.objects.create(name='clan%d' % i)
+            clans.append(clan)
+            for j, plr in enumerate(players[i * CLAN_SIZE:(i + 1) * CLAN_SIZE]):
+                plr.clan = clan
+                plr.clan_admin = j == 0
+        for plr in players:
+            plr.save()
+        call_command('aggregate')
+
+        # Each of these is aggregated on its own, so that the clans left dirty
+        # by one don't cover for what another should have marked.
+        self.append_xlog(src, lines[400:])
+        call_command('pollxlogs')
+        self.assertIncrementalMatchesFull()
+
+        # the clan that got the most deaths first, so that others take over
+        disbanded = Clan.objects.annotate(nfirst=Count('uniquedeath', filter=Q(uniquedeath__first=True))) \
+            .order_by('-nfirst', 'name')[0]
+        self.assertGreater(disbanded.nfirst, 0)
+        admin = Player.objects.get(clan=disbanded, clan_admin=True)
+        self.clanmgmt(admin, disband='')
+        self.assertFalse(Clan.objects.filter(id=disbanded.id).exists())
+        self.assertIncrementalMatchesFull()
+
+        clans = list(Clan.objects.order_by('name'))
+        members = { clan.id: list(Player.objects.filter(clan=clan).order_by('-clan_admin', 'name'))
+                    for clan in clans }
+        joiner = Player.objects.filter(clan=None).order_by('name')[0]
+        joiner.invites.add(clans[0])
+        self.clanmgmt(joiner, join_clan='', join_clan_id=clans[0].id)
+        self.assertEqual(joiner.clan_id, clans[0].id)
+
+        leaver = members[clans[1].id][1]
+        self.clanmgmt(leaver, leave='')
+        self.assertIsNone(leaver.clan_id)
+
+        kickee = members[clans[2].id][1]
+        self.clanmgmt(members[clans[2].id][0], kick='', kick_or_admin_id=kickee.id)
+        kickee.refresh_from_db()
+        self.assertIsNone(kickee.clan_id)
+        self.assertIncrementalMatchesFull()
@@ -0,0 +1,60 @@
+from django.core.management import call_command
+from scoreboard.models import Source, Game, Player, Death
+from datetime import datetime, timezone
+from .base import ScoreboardTransactionTestCase, test_xlog_lines
+from .test_pollxlogs import ended_late
+
+
+# Every Game with its conducts and achievements, and where each Source got
+# to, keyed by what identifies them rather than by id.
+def ingest_snapshot():
+    fields = [ f.attname for f in Game._meta.concrete_fields
+               if f.attname not in ('id', 'player_id', 'normalized_death_id', 'source_id') ]
+    key = ('player__name', 'starttime')
+    return {
+        'games': sorted(Game.objects.values_list(*key, 'source__server', 'normalized_death__name',
+                                                 *fields)),
+        'conducts': sorted(Game.conducts.through.objects
+                           .values_list(*('game__' + k for k in key), 'conduct__name')),
+        'achievements': sorted(Game.achievements.through.objects
+                               .values_list(*('game__' + k for k in key), 'achievement__name')),
+        'players': sorted(Player.objects.values_list('name', flat=True)),
+        'file_pos': sorted(Source.objects.values_list('server', 'file_pos')),
+    }
+
+
+# backfill commits per shard and closes the connection before starting its
+# workers, so this can't run inside a TestCase's transaction.
+class BackfillTest(ScoreboardTransactionTestCase):
+
+    def test_backfill_matches_pollxlogs(self):
+        self.xlog(test_xlog_lines())
+        # small shards, so that there are more of them than workers
+        call_command('backfill', workers=3, shard_bytes=20000)
+        backfilled = ingest_snapshot()
+        self.assertGreater(len(backfilled['games']), 0)
+
+        Game.objects.all().delete()
+        Player.objects.all().delete()
+        Death.objects.all().delete()
+        Source.objects.update(file_pos=0)
+        call_command('pollxlogs')
+        self.assertEqual(backfilled, ingest_snapshot())
+
+    def test_line_out_of_order_past_end(self):
+        lines = test_xlog_lines()
+        self.xlog(lines[:300] + [ ended_late(lines[300]) ] + lines[301:])
+        call_command('backfill', workers=3, shard_bytes=20000)
+        backfilled = ingest_snapshot()
+
+        Game.objects.all().delete()
+        Player.objects.all().delete()
+        Death.objects.all().delete()
+        Source.objects.update(file_pos=0)
+        call_command('pollxlogs')
+        self.assertEqual(backfilled, ingest_snapshot())
+        # the lines after the one that ended late got in, up to the last one
+        last = dict(field.split('=', 1) for field in lines[-1].rstrip('\n').split('\t'))
+        self.assertTrue(Game.objects.filter(
+            player__name=last['name'],
+            starttime=datetime.fromtimestamp(int(last['starttime']), timezone.utc)).exists())
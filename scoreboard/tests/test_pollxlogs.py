@@ -0,0 +1,59 @@
+from django.core.management import call_command
+from django.db.models import Count
+from scoreboard.models import Source, Game, Conduct, RecentGame
+from .base import ScoreboardTestCase, TEST_TOURNAMENT_END, test_xlog_lines
+from collections import defaultdict
+import os
+
+
+# A copy of an xlog line with the value of one of its fields replaced.
+def with_field(line, name, value):
+    return '\t'.join('%s=%s' % (name, value) if field.startswith(name + '=') else field
+                     for field in line.rstrip('\n').split('\t')) + '\n'
+
+
+# A copy of an xlog line, moved to have ended after the tournament.
+def ended_late(line):
+    return with_field(line, 'endtime', int(TEST_TOURNAMENT_END.timestamp()) + 3600)
+
+
+class PollxlogsTest(ScoreboardTestCase):
+
+    def test_line_out_of_order_past_end(self):
+        lines = test_xlog_lines()[:50]
+        in_order = self.xlog(lines, server='in_order')
+        out_of_order = self.xlog(lines[:20] + [ ended_late(lines[20]) ] + lines[21:],
+                                 server='out_of_order')
+        call_command('pollxlogs')
+        # only the game that ended late is missing
+        self.assertEqual(Game.objects.filter(source=out_of_order).count(),
+                         Game.objects.filter(source=in_order).count() - 1)
+        for src in Source.objects.all():
+            self.assertEqual(src.file_pos, os.path.getsize(src.local_file))
+
+    def test_every_conduct(self):
+        # a game that kept every conduct there is still makes the recent games
+        values = defaultdict(int)
+        for xlogfield, bit in Conduct.objects.values_list('xlogfield', 'bit'):
+            values[xlogfield] |= 1 << bit
+        line = test_xlog_lines()[0]
+        for xlogfield, value in values.items():
+            line = with_field(line, xlogfield, hex(value))
+        self.xlog([ line ])
+        call_command('pollxlogs')
+        game = Game.objects.get()
+        self.assertEqual(game.nconducts, Conduct.objects.count())
+        for recent in RecentGame.objects.all():
+            recent.full_clean()
+            self.assertEqual(recent.conducts,
+                             ' '.join(Conduct.objects.order_by('id').values_list('shortname', flat=True)))
+
+    def test_counts_match_decoded(self):
+        # nconducts and nachievements agree with the decoded through rows
+        self.xlog(test_xlog_lines())
+        call_command('pollxlogs')
+        games = Game.objects.annotate(conduct_rows=Count('conducts', distinct=True),
+                                      achievement_rows=Count('achievements', distinct=True))
+        self.assertTrue(any(g.nachievements > 0 for g in games))
+        for g in games:
+            self.assertEqual((g.nconducts, g.nachievements), (g.conduct_rows, g.achievement_rows))
@@ -0,0 +1,91 @@
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from scoreboard.models import Player, Clan, Game
+from tnnt import pagecache
+from tnnt.views import game_rows
+from .base import ScoreboardTestCase, test_xlog_lines
+
+
+class PageQueriesTest(ScoreboardTestCase):
+    # The public pages take a fixed number of queries, however many games,
+    # players and clans they list. Each count includes the one query for the
+    # data generation that every cached page starts with.
+
+    def setUp(self):
+        super().setUp()
+        self.xlog(test_xlog_lines())
+        call_command('pollxlogs')
+        players = list(Player.objects.order_by('name'))
+        for i in range(4):
+            clan = Clan.objects.create(name='clan%d' % i)
+            for j, plr in enumerate(players[i * 4:(i + 1) * 4]):
+                plr.clan = clan
+                plr.clan_admin = j == 0
+                plr.save()
+        call_command('aggregate')
+        # the page with the most of each, so any query per game or per member
+        # would show
+        self.player = Player.objects.order_by('-wins', 'name')[0]
+        self.clan = Clan.objects.order_by('-wins', 'name')[0]
+        self.assertGreater(self.player.wins, 2)
+
+    def assertPageQueries(self, url, num):
+        caches[pagecache.PAGE_CACHE].clear()
+        with self.assertNumQueries(num):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # and served from the cache, only the generation
+        with self.assertNumQueries(1):
+            self.client.get(url)
+
+    def test_game_rows(self):
+        # the games, and their conducts
+        game_qs = Game.objects.order_by('-endtime')
+        with self.assertNumQueries(2):
+            games = game_rows(game_qs)
+        self.assertEqual(len(games), game_qs.count())
+        self.assertTrue(any(g['conducts'] for g in games))
+
+    def test_homepage(self):
+        # SiteStats and RecentGame
+        self.assertPageQueries('/', 3)
+
+    def test_players(self):
+        # the players, with their clans and max conducts games joined in
+        self.assertPageQueries('/players', 2)
+
+    def test_clans(self):
+        # the clans, and their members
+        self.assertPageQueries('/clans', 3)
+
+    def test_leaderboards(self):
+        # the LeaderboardEntry rows
+        self.assertPageQueries('/leaderboards', 2)
+
+    def test_leaderboards_clan_change(self):
+        # a player's clan shows as it is now, not as of the last aggregate
+        def clans_shown(name):
+            response = self.client.get('/leaderboards')
+            return set(entry.get('clan') for board in response.context['leaderboards']
+                       for entry in board['players'] if entry['name'] == name)
+        leaver = Player.objects.filter(clan=self.clan, clan_admin=False).order_by('name')[0]
+        self.assertEqual(clans_shown(leaver.name), { leaver.clan.name })
+        leaver.user = User.objects.create(username=leaver.name)
+        leaver.save()
+        self.client.force_login(leaver.user)
+        self.client.post('/clanmgmt', { 'leave': '' })
+        self.assertEqual(clans_shown(leaver.name), { None })
+
+    def test_trophies(self):
+        # the trophies, and who has them among players and among clans
+        self.assertPageQueries('/trophies', 4)
+
+    def test_player(self):
+        # the player, 2 game_rows each for the ascensions and recent games,
+        # its trophies, the achievements and its unique deaths
+        self.assertPageQueries('/player/' + self.player.name, 9)
+
+    def test_clan(self):
+        # as for a player, plus the members
+        self.assertPageQueries('/clan/' + self.clan.name, 10)
@@ -0,0 +1,86 @@
+from django.test import SimpleTestCase
+from scoreboard.streaks import Streak, StreakTracker
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+import json
+import random
+
+# As much of a Game as streaks look at.
+FakeGame = namedtuple('FakeGame', ['id', 'starttime', 'endtime', 'won'])
+
+TOURNAMENT_START = datetime(2021, 11, 1, tzinfo=timezone.utc)
+
+
+# The streak scan StreakTracker replaced (Player.get_streaks before it), which
+# goes through every streak so far for each game.
+def reference_streaks(games):
+    streaks = []
+    for g in games:
+        extended_or_killed_streak = False
+        for strk in streaks:
+            if strk.continuable == False:
+                continue
+            if strk.games[-1].endtime < g.starttime:
+                extended_or_killed_streak = True
+                if g.won == False:
+                    strk.continuable = False
+                    continue
+                else:
+                    strk.games.append(g)
+                    break
+        if (not extended_or_killed_streak) and g.won:
+            streaks.append(Streak(g))
+    return [ strk for strk in streaks if len(strk.games) >= 2 ]
+
+
+# A player's games in starttime order, mostly winning and often overlapping
+# as if played on several servers at once, so that streaks are started,
+# extended and killed in every which way.
+def random_games(rng, ngames):
+    starttimes = rng.sample(range(0, 100 * ngames), ngames)
+    starttimes.sort()
+    return [ FakeGame(i + 1, TOURNAMENT_START + timedelta(seconds=start),
+                      TOURNAMENT_START + timedelta(seconds=start + rng.randrange(1, 300)),
+                      rng.random() < 0.7)
+             for i, start in enumerate(starttimes) ]
+
+
+# A tracker's state as saved in Player.streak_state.
+def saved_state(tracker):
+    return json.loads(json.dumps(tracker.state()))
+
+
+def summary(streaks):
+    return [ ([ g.id for g in strk.games ], strk.continuable) for strk in streaks ]
+
+
+class StreakTrackerTest(SimpleTestCase):
+
+    def test_matches_reference(self):
+        rng = random.Random(0)
+        for _ in range(2000):
+            games = random_games(rng, rng.randrange(0, 40))
+            expected = reference_streaks(games)
+            tracker = StreakTracker(keep_games=True)
+            for g in games:
+                tracker.add(g)
+            self.assertEqual(summary(tracker.get_streaks()), summary(expected), games)
+            self.assertEqual(tracker.longest,
+                             max((len(strk.games) for strk in expected), default=0), games)
+
+    def test_resume(self):
+        rng = random.Random(1)
+        for _ in range(500):
+            games = random_games(rng, rng.randrange(1, 40))
+            split = rng.randrange(0, len(games) + 1)
+            state = saved_state(StreakTracker.resume(None, games[:split]))
+            self.assertEqual(saved_state(StreakTracker.resume(state, games)),
+                             saved_state(StreakTracker.resume(None, games)))
+
+    def test_resume_replays_earlier_game(self):
+        rng = random.Random(2)
+        games = random_games(rng, 30)
+        state = saved_state(StreakTracker.resume(None, games[1:]))
+        # games[0] started before everything the state has seen
+        self.assertEqual(saved_state(StreakTracker.resume(state, games)),
+                         saved_state(StreakTracker.resume(None, games)))
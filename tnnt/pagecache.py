@@ -0,0 +1,55 @@
+# Cache of the rendered public pages, keyed on the data generation (see
+# DataGeneration in scoreboard/models.py). Everything that changes what those
+# pages show bumps the generation, so a page cached under the current one is
+# always up to date, and a bump makes all of them stale at once without having
+# to find and delete anything.
+#
+# When a page isn't cached for the current generation, only one request at a
+# time works it out again. Any others asking for the same page meanwhile get
+# the copy from an earlier generation if there is one, or otherwise wait for
+# that request to finish, rather than all recomputing it at once.
+from django.core.cache import caches
+from scoreboard.models import DataGeneration
+import time
+
+# the cache (from settings.CACHES) the pages go in
+PAGE_CACHE = 'pages'
+
+# How long one request may spend working out a page before others stop waiting
+# for it and do it themselves, and how often they check on it, in seconds.
+RENDER_LOCK_TIMEOUT = 30
+RENDER_WAIT_INTERVAL = 0.05
+
+# Return the page identified by key (anything that tells it apart from other
+# pages, e.g. which player it is for), as rendered by render() for the
+# current generation.
+def get_page(key, render):
+    cache = caches[PAGE_CACHE]
+    generation = DataGeneration.objects.current()
+    page_key = 'page:%d:%s' % (generation, key)
+    content = cache.get(page_key)
+    if content is not None:
+        return content
+
+    latest_key = 'latest:' + key
+    lock_key = 'rendering:%d:%s' % (generation, key)
+    if cache.add(lock_key, True, RENDER_LOCK_TIMEOUT):
+        try:
+            content = render()
+            cache.set_many({ page_key: content, latest_key: content })
+        finally:
+            cache.delete(lock_key)
+        return content
+
+    # someone else is working it out
+    stale = cache.get(latest_key)
+    if stale is not None:
+        return stale
+    deadline = time.monotonic() + RENDER_LOCK_TIMEOUT
+    while time.monotonic() < deadline and cache.get(lock_key) is not None:
+        time.sleep(RENDER_WAIT_INTERVAL)
+        content = cache.get(page_key)
+        if content is not None:
+            return content
+    content = cache.get(page_key)
+    return content if content is not None else render()
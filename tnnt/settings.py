@@ -104,6 +104,29 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# 'pages' holds the rendered public pages (see tnnt/pagecache.py). Its entries
+# are keyed on the data generation, so nothing has to expire them by hand.
+# Local memory is per process; to share the pages between several server
+# processes, use a file-based cache instead:
+#   'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+#   'LOCATION': '/var/tmp/tnnt_pages',
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tnnt-pages',
+        'TIMEOUT': 24 * 60 * 60,
+        # one page per player and clan, for the current and previous generation
+        'OPTIONS': { 'MAX_ENTRIES': 10000 },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -179,6 +202,11 @@ MAX_CLAN_PLAYERS = 12
 
 CLAN_FREEZE_TIME = datetime.fromisoformat('2021-11-10T00:00:00+00:00')
 
+# How many places each leaderboard page shows (None for everyone). The
+# leaderboards are ranked in full during aggregation either way.
+
+LEADERBOARD_MAX_RANK = None
+
 # Tournament start/end times
 
 TOURNAMENT_START = datetime.fromisoformat('2021-11-01T00:00:00+00:00')
@@ -223,6 +251,8 @@ LOGGING = {
 # Normalizations are a list of 2-tuples of regex and string, which will be the
 # first and second arguments to a re.sub() call whose third argument is the
 # death string. They are executed in the order they appear here.
+# Games store their normalized death when they are ingested, so after changing
+# either list, run `./manage.py renormalize_deaths` and then aggregate.
 UNIQUE_DEATH_REJECTIONS = [
     r"^ascended",
     r"^quit",
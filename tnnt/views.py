@@ -1,25 +1,47 @@
 from django.views.generic import TemplateView
 from django.views import View
 from django.shortcuts import render, get_object_or_404
-from django.db.models import Exists, OuterRef, F, Count, Value, Sum
+from django.db.models import Exists, OuterRef, F, Count, Value
 from scoreboard.models import *
 from tnnt.forms import CreateClanForm, InviteMemberForm
 from django.http import HttpResponse, HttpResponseRedirect
 from . import hardfought_utils # find_player
 from . import dumplog_utils # format_dumplog
+from . import pagecache
 from . import settings
+from scoreboard.leaderboards import LEADERBOARDS
+from urllib.parse import quote
+from collections import defaultdict
 from datetime import datetime, timezone
 import logging
-from tnnt import uniqdeaths
 
 logger = logging.getLogger() # use root logger
 
+# The Game fields that the game listings (gamerow.html) show.
+GAME_ROW_FIELDS = ['id', 'won', 'role', 'race', 'gender0', 'align0', 'turns', 'points',
+                   'wallclock', 'starttime', 'endtime', 'death']
+
 # Convenience function, not a view.
-# Given a list of dicts containing Game fields (specifically 'playername',
-# 'dlg_fmt' and 'starttime'), also insert a 'dumplog' field into each of those
-# dicts containing the formatted dumplog URL.
-def bulk_upd_games(gamelist):
-    for g in gamelist:
+# Return the Games in game_qs as a list of dicts for the game listings: their
+# GAME_ROW_FIELDS, plus the player's name ('playername'), the dumplog URL
+# ('dumplog'), the Rol-Rac-Gen-Aln string ('rrga'), and the shortnames of the
+# game's conducts ('conducts'). This takes 2 queries, however many Games there
+# are.
+def game_rows(game_qs):
+    games = list(game_qs.values(*GAME_ROW_FIELDS, playername=F('player__name'),
+                                dlg_fmt=F('source__dumplog_fmt')))
+
+    # This used to be Game.conducts_as_str, whose description was:
+    # > Return a string containing this game's conducts in human readable form
+    # > e.g. "poly wish veg"
+    # and was a query per game; now it's one query for all of them.
+    conducts = defaultdict(list)
+    for game_id, shortname in Game.conducts.through.objects \
+            .filter(game__in=[ g['id'] for g in games ]).order_by('conduct_id') \
+            .values_list('game_id', 'conduct__shortname'):
+        conducts[game_id].append(shortname)
+
+    for g in games:
         g['dumplog'] = dumplog_utils.format_dumplog(g['dlg_fmt'], g['playername'],
                                                     g['starttime'])
 
@@ -27,36 +49,40 @@ def bulk_upd_games(gamelist):
         # formatting, that function is used in aggregation
         g['rrga'] = '-'.join([g['role'], g['race'], g['gender0'], g['align0']])
 
-        # post 2021 TODO: this is not ideal because it's an extra query per each
-        # ascension in the list. but perhaps not worth the headache of making
-        # all these preproc'd Game lists into Game-x-Conduct lists.
-        # This used to be Game.conducts_as_str, whose description was:
-        # > Return a string containing this game's conducts in human readable form
-        # > e.g. "poly wish veg"
-        g['conducts'] = [ c.shortname for c in Conduct.objects.filter(game__id=g['id']) ]
+        g['conducts'] = conducts[g['id']]
+
+    return games
 
-    return gamelist
+# Mixin for the public pages, which only show data that changes when the data
+# generation does: the rendered page comes from tnnt/pagecache.py. The header
+# differs for logged in users, so there are two copies of each page.
+class CachedPageMixin:
+    # What tells this page apart from the others.
+    def page_cache_key(self):
+        return type(self).__name__
+
+    def get(self, request, *args, **kwargs):
+        key = '%s:%s' % (self.page_cache_key(),
+                         'user' if request.user.is_authenticated else 'anon')
+        render = lambda: super(CachedPageMixin, self).get(request, *args, **kwargs).render().content
+        return HttpResponse(pagecache.get_page(key, render))
 
-class HomepageView(TemplateView):
+class HomepageView(CachedPageMixin, TemplateView):
     template_name = 'index.html'
 
     def get_context_data(self, **kwargs):
-        # general statistics
-        kwargs['numclans'] = Clan.objects.count()
-        kwargs['numplayers'] = Player.objects.count()
-        kwargs['numgames'] = Game.objects.count()
-        aggr = Player.objects.aggregate(Sum('games_scummed'), Sum('wins'))
-        kwargs['numscums'] = aggr['games_scummed__sum']
-        kwargs['numascs'] = aggr['wins__sum']
-        kwargs['numascenders'] = Player.objects.filter(wins__gt=0).count()
-
-        # last 10 games/wins
-        base_qs = Game.objects.annotate(
-            playername=F('player__name'),
-            dlg_fmt=F('source__dumplog_fmt')).order_by('-endtime')
-        kwargs['last10games'] = bulk_upd_games(list(base_qs.values()[:10]))
-        kwargs['last10wins'] = \
-            bulk_upd_games(list(base_qs.filter(won=True).values()[:10]))
+        # general statistics, as kept up to date by ingest and aggregation
+        site_stats = SiteStats.objects.current()
+        for field in ('numclans', 'numplayers', 'numgames', 'numscums', 'numascs',
+                      'numascenders'):
+            kwargs[field] = getattr(site_stats, field)
+
+        # last 10 games/wins, from the RecentGame buffers
+        kwargs['last10games'] = []
+        kwargs['last10wins'] = []
+        for g in RecentGame.objects.order_by('-endtime').values():
+            g['conducts'] = g['conducts'].split()
+            kwargs['last10wins' if g['won_only'] else 'last10games'].append(g)
 
         return kwargs
 
@@ -69,7 +95,7 @@ class AboutView(TemplateView):
 class ArchivesView(TemplateView):
     template_name = 'archives.html'
 
-class LeaderboardsView(TemplateView):
+class LeaderboardsView(CachedPageMixin, TemplateView):
     template_name = 'leaderboards.html'
 
     def get_context_data(self, **kwargs):
@@ -79,162 +105,48 @@ class LeaderboardsView(TemplateView):
         #    'name': 'someplayer',
         #    OPTIONAL: (indicates this is a player in a clan)
         #    'clan': 'someclan',
-        #    'stat': 304, # num of wins, etc.
+        #    'stat': '304', # num of wins, etc, already formatted
         #    OPTIONAL: (indicates template should render as a link)
         #    'dumplog': 'https://hardfought.org/blah/blah.html'
         # },
-
-        # *_stt is the starttime of a game, *_dlg is the dumplog format, and
-        # *_nam is the name of the player of the game.
-        # These are necessary so that we can generate the dumplog here in the
-        # view rather than telling the Game to go look up its Player and Source
-        # for extra queries. (The player's name would not be necessary for the
-        # player leaderboard, but is necessary for the clan leaderboard.)
-        # A possible optimization would be to inject the F(game__player__name)
-        # for the Clan query only, and for the Player query just use F(name).
-        annotate_kwargs = {
-            'firstasc':        F('first_asc__endtime'),
-            'firstasc_stt':    F('first_asc__starttime'),
-            'firstasc_dlg':    F('fastest_realtime_asc__source__dumplog_fmt'),
-            'firstasc_nam':    F('fastest_realtime_asc__player__name'),
-
-            'minturns':        F('lowest_turncount_asc__turns'),
-            'minturns_stt':    F('lowest_turncount_asc__starttime'),
-            'minturns_dlg':    F('lowest_turncount_asc__source__dumplog_fmt'),
-            'minturns_nam':    F('lowest_turncount_asc__player__name'),
-
-            'mintime':         F('fastest_realtime_asc__wallclock'),
-            'mintime_stt':     F('fastest_realtime_asc__starttime'),
-            'mintime_dlg':     F('fastest_realtime_asc__source__dumplog_fmt'),
-            'mintime_nam':     F('fastest_realtime_asc__player__name'),
-
-            # counting with distinct=True is needed here because we aggregate
-            # both conducts and achievements - the resulting SQL join produces
-            # (#cond x #ach) records per Game under the hood. Counting without
-            # distinct will result in that product being the result for both.
-            'maxcond':         Count('max_conducts_asc__conducts', distinct=True),
-            'maxcond_stt':     F('max_conducts_asc__starttime'),
-            'maxcond_dlg':     F('max_conducts_asc__source__dumplog_fmt'),
-            'maxcond_nam':     F('max_conducts_asc__player__name'),
-
-            'mostachgame':     Count('max_achieves_game__achievements', distinct=True),
-            'mostachgame_stt': F('max_achieves_game__starttime'),
-            'mostachgame_dlg': F('max_achieves_game__source__dumplog_fmt'),
-            'mostachgame_nam': F('max_achieves_game__player__name'),
-
-            'minscore':        F('min_score_asc__points'),
-            'minscore_stt':    F('min_score_asc__starttime'),
-            'minscore_dlg':    F('min_score_asc__source__dumplog_fmt'),
-            'minscore_nam':    F('min_score_asc__player__name'),
-
-            'maxscore':        F('max_score_asc__points'),
-            'maxscore_stt':    F('max_score_asc__starttime'),
-            'maxscore_dlg':    F('max_score_asc__source__dumplog_fmt'),
-            'maxscore_nam':    F('max_score_asc__player__name'),
-        }
-
-        # Now do the actual queries. Only 2 queries!
-        allplayers = list(Player.objects
-                                .filter(total_games__gt = 0)
-                                .annotate(clanname=F('clan__name'), **annotate_kwargs)
-                                .values())
-        winplayers = [ plr for plr in allplayers if plr['wins'] > 0 ]
-        allclans = list(Clan.objects
-                            .filter(total_games__gt = 0)
-                            .annotate(**annotate_kwargs)
-                            .values())
-        winclans = [ clan for clan in allclans if clan['wins'] > 0 ]
-
-        # This function takes one of the four lists above, and formats each
-        # dictionary appropriately for consumption by the template.
-        def gen_leader_list(base_list, stat, descending):
-            list_out = []
-            # Note: this sorting will put players with the same amount of wins
-            # (or whatever metric stat is) in arbitrary order.
-            # post 2021 TODO: a good enhancement would be to order it by the
-            # first player to get there
-            for elem in sorted(base_list, key=lambda E: E[stat], reverse=descending):
-                if not stat in elem or elem[stat] is None:
-                    # could indicate a field was not correctly populated during
-                    # aggregation, such as a Player who has wins > 0 but
-                    # first_asc is None
-                    logger.error('malformed query result for leaderboards')
-                    logger.error('stat = %s element = %s', stat, str(elem))
-                    return []
-                # elem is either a player or a clan, but this loop doesn't care
-                # which
-                converted = {
-                    'name': elem['name'],
-                    'stat': elem[stat],
-                }
-                if 'clanname' in elem and elem['clanname'] is not None:
-                    # this is a player, and we want to show the clan
-                    converted['clan'] = elem['clanname']
-                if (stat + '_stt') in elem:
-                    # this is a stat representing a single game, so it has an
-                    # associated dumplog
-                    converted['dumplog'] = \
-                        dumplog_utils.format_dumplog(elem[stat + '_dlg'],
-                                                     elem[stat + '_nam'],
-                                                     elem[stat + '_stt'])
-                list_out.append(converted)
-            return list_out
-
-        # The order of these leaderboards determines the order on the page and
-        # in the combo box.
-        leaderboards = [
-            # if stat is absent, then just use id as the stat
-            { 'id': 'mostasc', 'stat': 'wins', 'descending': True, 'wins_only': True,
-              'title': 'Most Ascensions', 'columntitle': 'wins' },
-            { 'id': 'firstasc', 'descending': False, 'wins_only': True,
-              'title': 'Earliest Ascension', 'columntitle': 'time' },
-            { 'id': 'minturns', 'descending': False, 'wins_only': True,
-              'title': 'Lowest Turncount', 'columntitle': 'turns' },
-            { 'id': 'mintime', 'descending': False, 'wins_only': True,
-              'title': 'Fastest Realtime', 'columntitle': 'wallclock' },
-            { 'id': 'maxcond', 'descending': True, 'wins_only': True,
-              'title': 'Most Conducts in One Ascension', 'columntitle': 'conducts' },
-            { 'id': 'mostachgame', 'descending': True, 'wins_only': False,
-              'title': 'Most Achievements in One Game', 'columntitle': 'achievements' },
-            { 'id': 'mostach', 'descending': True, 'stat': 'unique_achievements',
-              'wins_only': False,
-              'title': 'Most Achievements Overall', 'columntitle': 'achievements' },
-            { 'id': 'minscore', 'descending': False, 'wins_only': True,
-              'title': 'Lowest Scoring Ascension', 'columntitle': 'points' },
-            { 'id': 'maxscore', 'descending': True, 'wins_only': True,
-              'title': 'Highest Scoring Ascension', 'columntitle': 'points' },
-            { 'id': 'longstreak', 'stat': 'longest_streak', 'descending': True,
-              'wins_only': True,
-              'title': 'Longest Streak', 'columntitle': 'streak length' },
-            { 'id': 'uniquedeaths', 'stat': 'unique_deaths', 'descending': True,
-              'wins_only': False,
-              'title': 'Most Unique Deaths', 'columntitle': 'deaths' },
-            { 'id': 'uniqueasc', 'stat': 'unique_ascs', 'descending': True,
-              'wins_only': True,
-              'title': 'Most Unique Ascension Combos', 'columntitle': 'combos' },
-            { 'id': 'mostgames', 'stat': 'games_over_1000_turns', 'descending': True,
-              'wins_only': False,
-              'title': 'Most Games over 1000 Turns', 'columntitle': 'games' },
-        ]
-        # now add player/clan data to the leaderboards
-        for L in leaderboards:
-            L['players'] = gen_leader_list(winplayers if L['wins_only'] else allplayers,
-                                           L['stat'] if 'stat' in L else L['id'],
-                                           L['descending'])
-            L['clans'] = gen_leader_list(winclans if L['wins_only'] else allclans,
-                                         L['stat'] if 'stat' in L else L['id'],
-                                         L['descending'])
+        # The aggregate command has already ranked everyone on every board
+        # (see scoreboard.leaderboards), so this is a single query on the
+        # LeaderboardEntry index. With LEADERBOARD_MAX_RANK set, how much of
+        # it is read and rendered doesn't grow with the number of players.
+        # A player's clan is looked up here rather than stored with the entry,
+        # since joining or leaving a clan doesn't re-run aggregation.
+        leaderboards = [ dict(L, players=[], clans=[]) for L in LEADERBOARDS ]
+        by_id = { L['id']: L for L in leaderboards }
+        entries = LeaderboardEntry.objects.order_by('board', 'is_clan', 'rank')
+        if settings.LEADERBOARD_MAX_RANK is not None:
+            entries = entries.filter(rank__lte=settings.LEADERBOARD_MAX_RANK)
+        for entry in entries.values('board', 'is_clan', 'name', 'stat', 'dumplog',
+                                    clan_name=F('player__clan__name')):
+            if entry['board'] not in by_id:
+                # a board that has since been removed, until the next aggregation
+                continue
+            converted = { 'name': entry['name'], 'stat': entry['stat'] }
+            if entry['clan_name'] is not None:
+                # this is a player, and we want to show the clan
+                converted['clan'] = entry['clan_name']
+            if entry['dumplog'] is not None:
+                # this is a stat representing a single game
+                converted['dumplog'] = entry['dumplog']
+            by_id[entry['board']]['clans' if entry['is_clan'] else 'players'].append(converted)
         kwargs['leaderboards'] = leaderboards
         return kwargs
 
-class PlayersView(TemplateView):
+class PlayersView(CachedPageMixin, TemplateView):
     template_name = 'players.html'
 
     def get_context_data(self, **kwargs):
-        kwargs['players'] = Player.objects.order_by('-wins', 'name')
+        # the clan and max conducts game are shown for every player, so they
+        # come in the same query
+        kwargs['players'] = Player.objects.select_related('clan', 'max_conducts_asc') \
+            .order_by('-wins', 'name')
         return kwargs
 
-class ClansView(TemplateView):
+class ClansView(CachedPageMixin, TemplateView):
     template_name = 'clans.html'
 
     def get_context_data(self, **kwargs):
@@ -272,9 +184,15 @@ class ClansView(TemplateView):
         kwargs['clans'] = clanlist
         return kwargs
 
-class SinglePlayerOrClanView(TemplateView):
+class SinglePlayerOrClanView(CachedPageMixin, TemplateView):
     template_name = 'singleplayerorclan.html'
 
+    # one page per player and per clan
+    def page_cache_key(self):
+        if 'clanname' in self.kwargs:
+            return 'clan:' + quote(self.kwargs['clanname'])
+        return 'player:' + quote(self.kwargs['playername'])
+
     def get_context_data(self, **kwargs):
         if 'clanname' in kwargs:
             kwargs['isClan'] = True
@@ -302,19 +220,20 @@ class SinglePlayerOrClanView(TemplateView):
             logger.error('single player/clan view without clan or player name')
             raise ValueError
 
-        # add information to the Game queryset that lets us generate dumplogs,
-        # and default sorting
-        base_game_qs = base_game_qs.annotate(playername=F('player__name'),
-                                             dlg_fmt=F('source__dumplog_fmt')) \
-                                   .order_by('-endtime')
-        kwargs['ascensions'] = \
-            bulk_upd_games(list(base_game_qs.filter(won=True).values()))
+        # default sorting
+        base_game_qs = base_game_qs.order_by('-endtime')
+        kwargs['ascensions'] = game_rows(base_game_qs.filter(won=True))
         # 10 most recent games
-        kwargs['recentgames'] = \
-            bulk_upd_games(list(base_game_qs[:10].values()))
+        kwargs['recentgames'] = game_rows(base_game_qs[:10])
 
-        # post 2021 TODO: this currently only gets the deaths, no other details
-        kwargs['uniquedeaths'] = sorted(list(uniqdeaths.compile_unique_deaths(base_game_qs)))
+        # each unique death with who got it first and when, as worked out by
+        # aggregate
+        if kwargs['isClan']:
+            uniquedeaths = UniqueDeath.objects.filter(clan=kwargs['player_or_clan'])
+        else:
+            uniquedeaths = UniqueDeath.objects.filter(player=kwargs['player_or_clan'])
+        kwargs['uniquedeaths'] = uniquedeaths.order_by('death__name') \
+            .values('death__name', 'endtime', 'first', 'game__player__name')
 
         # a little subquerying for achievements...
         gameswith_ach = base_game_qs.filter(achievements__pk=OuterRef('pk'))
@@ -323,7 +242,7 @@ class SinglePlayerOrClanView(TemplateView):
 
         return kwargs
 
-class TrophiesView(TemplateView):
+class TrophiesView(CachedPageMixin, TemplateView):
     template_name = 'trophies.html'
 
     def get_context_data(self, **kwargs):
@@ -362,7 +281,25 @@ class TrophiesView(TemplateView):
         kwargs['trophies'] = trophies
         return kwargs
 
-class AchievementsView(TemplateView):
+class UniqueDeathsView(CachedPageMixin, TemplateView):
+    template_name = 'uniquedeaths.html'
+
+    def get_context_data(self, **kwargs):
+        # the first player and the first clan to get each death, from one query
+        deaths = {}
+        for ud in UniqueDeath.objects.filter(first=True).order_by('death__name') \
+                .values('death__name', 'endtime', 'player__name', 'clan__name'):
+            death = deaths.setdefault(ud['death__name'], { 'name': ud['death__name'] })
+            if ud['clan__name'] is None:
+                death['player'] = ud['player__name']
+                death['player_time'] = ud['endtime']
+            else:
+                death['clan'] = ud['clan__name']
+                death['clan_time'] = ud['endtime']
+        kwargs['deaths'] = list(deaths.values())
+        return kwargs
+
+class AchievementsView(CachedPageMixin, TemplateView):
     template_name = 'achievements.html'
 
     def get_context_data(self, **kwargs):
@@ -495,6 +432,11 @@ class ClanMgmtView(View):
         elif 'kick' in request.POST:
             self.kick_member(request, player, ctx)
 
+        # Clan membership shows on the public pages, so whatever was done here
+        # makes their cached copies stale. (A bump for a request that was
+        # turned down costs no more than one page being worked out again.)
+        DataGeneration.objects.bump()
+
         return render(request, self.template_name, self.get_context_data(**ctx))
 
     # Helper function triggered when a create_clan POST request comes in
@@ -530,6 +472,7 @@ class ClanMgmtView(View):
         # admin
         newclan = Clan(name=new_clan_name)
         newclan.save()
+        SiteStats.objects.add(numclans=1)
         player.clan = newclan
         player.clan_admin = True
         player.save()
@@ -607,6 +550,9 @@ class ClanMgmtView(View):
         save_clan_name = player.clan.name
         player.clan = None
         player.save()
+        # the clan's aggregates no longer include this player's games; use
+        # update() so as not to write back stale leaderboard fields
+        Clan.objects.filter(id=clan.id).update(dirty=True)
         logger.info('%s left clan %s', player.name, save_clan_name)
 
     # Helper function triggered when "disband" is clicked
@@ -636,6 +582,7 @@ class ClanMgmtView(View):
             member.save()
         save_clan_name = player.clan.name
         clan.delete()
+        SiteStats.objects.add(numclans=-1)
         logger.info('%s disbanded clan %s',
                     player.name, save_clan_name)
 
@@ -691,6 +638,7 @@ class ClanMgmtView(View):
                            player.name)
         player.clan_admin = False # to be safe
         player.save()
+        Clan.objects.filter(id=newclan.id).update(dirty=True)
         # A bit questionable whether the invite should be left in place or
         # removed here, but we decided that if a player leaves or is kicked from
         # the clan, it's cleaner if they have to ask for the invite again
@@ -802,6 +750,7 @@ class ClanMgmtView(View):
         kickee.clan = None
         kickee.clan_admin = False
         kickee.save()
+        Clan.objects.filter(id=player.clan_id).update(dirty=True)
         logger.info('%s kicked %s out of clan %s',
                     player.name, kickee.name, player.clan.name)
         # FUTURE TODO: would be nice if this and all the other post operations